@@ -0,0 +1,109 @@
+#-*- coding:utf-8 -*-
+#write a sample corpus through the Writer with every codec and level
+#usage: python bench/bench_codec.py [--corpus dir] [--messages 2000]
+#                                   [--writers 2]
+import argparse
+import base64
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mail3
+
+WORDS = ('meeting report invoice attached please find below regards thanks '
+         'project schedule update review budget contract delivery office '
+         'customer order shipment payment team weekly status').split()
+
+
+def make_corpus(messages, seed=1):
+    #text parts with a base64 attachment on every fourth message
+    rnd = random.Random(seed)
+    corpus = []
+    for i in range(messages):
+        lines = [
+            'From: sender{0}@example.com'.format(i % 50),
+            'To: rcpt@example.com',
+            'Subject: {0}'.format(' '.join(rnd.sample(WORDS, 4))),
+            'Content-Type: multipart/mixed; boundary="b"', '', '--b',
+            'Content-Type: text/plain; charset=utf-8', ''
+        ]
+        for _ in range(rnd.randint(10, 200)):
+            lines.append(' '.join(rnd.choice(WORDS) for _ in range(12)))
+        if i % 4 == 0:
+            blob = bytes(rnd.getrandbits(8) for _ in range(rnd.randint(
+                0x1000, 0x10000)))
+            b64 = base64.encodebytes(blob).decode('ascii')
+            lines.extend([
+                '--b', 'Content-Type: application/octet-stream',
+                'Content-Transfer-Encoding: base64', '', b64
+            ])
+        lines.append('--b--')
+        corpus.append('\r\n'.join(lines).encode('utf-8'))
+    return corpus
+
+
+def load_corpus(path, messages):
+    corpus = []
+    for d, _, files in os.walk(path):
+        for f in files:
+            if f.endswith('.eml'):
+                with open(os.path.join(d, f), 'rb') as fp:
+                    corpus.append(fp.read())
+                if len(corpus) >= messages:
+                    return corpus
+    return corpus
+
+
+def disk_usage(root):
+    total = 0
+    for d, _, files in os.walk(root):
+        for f in files:
+            total += os.path.getsize(os.path.join(d, f))
+    return total
+
+
+def run(corpus, codec, level, writers):
+    root = tempfile.mkdtemp()
+    writer = mail3.Writer(writers, 0x40, codec=mail3.CODECS[codec](level))
+    batch = writer.batch()
+    start = time.time()
+    for i, data in enumerate(corpus):
+        path = os.path.join(root, '{0}.eml'.format(i))
+        writer.submit(batch, path, data, path)
+    batch.wait()
+    writer.close()
+    cost = time.time() - start
+    size = disk_usage(root)
+    shutil.rmtree(root)
+    return cost, size
+
+
+def main():
+    p = argparse.ArgumentParser(description='stored message codec benchmark')
+    p.add_argument('--corpus', help='directory of .eml files to use')
+    p.add_argument('--messages', type=int, default=2000)
+    p.add_argument('--writers', type=int, default=2)
+    args = p.parse_args()
+    if args.corpus:
+        corpus = load_corpus(args.corpus, args.messages)
+    else:
+        corpus = make_corpus(args.messages)
+    raw = sum(len(x) for x in corpus)
+    print('%d messages, %.1f MB' % (len(corpus), raw / 1048576.0))
+    cases = [('none', -1)]
+    for codec in ('zlib', 'gzip'):
+        cases.extend((codec, level) for level in (1, 6, 9))
+    for codec, level in cases:
+        cost, size = run(corpus, codec, level, args.writers)
+        print('%-5s level %2d %7.1f MB/s %7.1f MB on disk ratio %.2f' %
+              (codec, level, raw / 1048576.0 / cost, size / 1048576.0,
+               raw / float(size)))
+
+
+if __name__ == '__main__':
+    main()
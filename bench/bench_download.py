@@ -0,0 +1,64 @@
+#-*- coding:utf-8 -*-
+#compare sequential account download with the executor backed engine
+#usage: python bench/bench_download.py [--accounts 20] [--latency 0.02]
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakeimap
+import mail3
+
+
+def run(server, accounts, poolsize, hostlimit, pagesize):
+    root = tempfile.mkdtemp()
+    #every run needs a fresh loop, download closes it
+    mail3.asyncio.set_event_loop(mail3.asyncio.new_event_loop())
+    users = dict(('user{0}@example.com'.format(i), 'secret')
+                 for i in range(accounts))
+    m = mail3.Mailer(
+        root=root,
+        imap=server.address,
+        poolsize=poolsize,
+        hostlimit=hostlimit,
+        pagesize=pagesize,
+        timeout=30,
+        **users)
+    start = time.time()
+    m.download()
+    cost = time.time() - start
+    shutil.rmtree(root)
+    return cost
+
+
+def main():
+    p = argparse.ArgumentParser(description='download engine benchmark')
+    p.add_argument('--accounts', type=int, default=20)
+    p.add_argument('--messages', type=int, default=5)
+    p.add_argument('--latency', type=float, default=0.02)
+    p.add_argument('--pagesize', type=int, default=0x64)
+    args = p.parse_args()
+    server = fakeimap.FakeIMAPServer(
+        folders={
+            'INBOX': fakeimap.Mailbox(args.messages),
+            'Sent': fakeimap.Mailbox(args.messages)
+        },
+        latency=args.latency).start()
+    try:
+        serial = run(server, args.accounts, 1, 1, args.pagesize)
+        overlap = run(server, args.accounts, args.accounts, args.accounts,
+                      args.pagesize)
+    finally:
+        server.stop()
+    print('\naccounts=%d latency=%.3fs' % (args.accounts, args.latency))
+    print('sequential  %.2fs' % serial)
+    print('concurrent  %.2fs (x%.1f)' % (overlap, serial / overlap))
+
+
+if __name__ == '__main__':
+    main()
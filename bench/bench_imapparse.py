@@ -0,0 +1,196 @@
+#-*- coding:utf-8 -*-
+#replay a recorded imap session through the response parser
+#usage: python bench/bench_imapparse.py [--lines 100000] [--record file]
+#                                       [--session file] [--rounds 3]
+#                                       [--trace ring]
+#without --session a session is recorded from the fake server first, the
+#old regex parser is replayed next to the current one for comparison
+import argparse
+import io
+import os
+import re
+import sys
+import time
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH))
+sys.path.insert(0, BENCH)
+
+import fakeimap
+import imaplib
+
+
+class Tee():
+    #copies everything read from the server into out
+    def __init__(self, f, out):
+        self.f = f
+        self.out = out
+
+    def readline(self, *args):
+        line = self.f.readline(*args)
+        self.out.write(line)
+        return line
+
+    def read(self, size):
+        data = self.f.read(size)
+        self.out.write(data)
+        return data
+
+    def readinto(self, buf):
+        n = self.f.readinto(buf)
+        self.out.write(bytes(buf[:n]))
+        return n
+
+    def close(self):
+        self.f.close()
+
+
+def record(lines, size=200):
+    #envelope page, body page and a search, about 3 lines per message
+    messages = max(1, lines // 3)
+    s = fakeimap.FakeIMAPServer(
+        folders={'INBOX': fakeimap.Mailbox(messages, size=size)}).start()
+    host, port = s.server_address
+    m = imaplib.IMAP4(host, port)
+    out = io.BytesIO()
+    m.file = Tee(m.file, out)
+    m.login('user@example.com', 'p')
+    m.select('INBOX')
+    m.uid('SEARCH', 'ALL')
+    for start in range(1, messages + 1, 1000):
+        spec = '{0}:{1}'.format(start, min(start + 999, messages))
+        m.uid('FETCH', spec, '(UID RFC822.SIZE INTERNALDATE ENVELOPE)')
+        m.uid('FETCH', spec, '(UID BODY.PEEK[])')
+    tagpre = m.tagpre
+    m.logout()
+    s.stop()
+    return tagpre + b'\n' + out.getvalue()
+
+
+class Tags(dict):
+    #every tag in the recording counts as ours
+    def __contains__(self, tag):
+        return True
+
+
+class Replay(imaplib.IMAP4):
+    def __init__(self, session):
+        self.session = session
+        imaplib.IMAP4.__init__(self)
+
+    def open(self, host='', port=0):
+        tagpre, _, data = self.session.partition(b'\n')
+        self.tagpre = tagpre
+        self.file = io.BytesIO(data)
+
+    def _connect(self):
+        self.tagre = re.compile(
+            br'(?P<tag>' + self.tagpre + br'\d+) (?P<type>[A-Z]+) (?P<data>.*)',
+            re.ASCII)
+        self.tagged_commands = Tags()
+        if __debug__:
+            self._trace = imaplib.Trace() if imaplib.Trace else None
+
+    def send(self, data):
+        pass
+
+    def replay(self):
+        count = 0
+        end = len(self.session) - len(self.tagpre) - 1
+        while self.file.tell() < end:
+            self._get_response()
+            count += 1
+        return count
+
+
+class Legacy(Replay):
+    #the parser before first byte dispatch, regexes tried in turn
+    def _get_response(self):
+        resp = self._get_line()
+        if self._match(self.tagre, resp):
+            tag = self.mo.group('tag')
+            if not tag in self.tagged_commands:
+                raise self.abort('unexpected tagged response: %r' % resp)
+            typ = self.mo.group('type')
+            typ = str(typ, self._encoding)
+            dat = self.mo.group('data')
+            self.tagged_commands[tag] = (typ, [dat])
+        else:
+            dat2 = None
+            if not self._match(imaplib.Untagged_response, resp):
+                if self._match(self.Untagged_status, resp):
+                    dat2 = self.mo.group('data2')
+            if self.mo is None:
+                if self._match(imaplib.Continuation, resp):
+                    self.continuation_response = self.mo.group('data')
+                    return None
+                raise self.abort("unexpected response: %r" % resp)
+            typ = self.mo.group('type')
+            typ = str(typ, self._encoding)
+            dat = self.mo.group('data')
+            if dat is None: dat = b''
+            if dat2: dat = dat + b' ' + dat2
+            while self._match(self.Literal, dat):
+                size = int(self.mo.group('size'))
+                data = self._read_literal(size)
+                self._append_untagged(typ, (dat, data))
+                dat = self._get_line()
+            self._append_untagged(typ, dat)
+        if typ in ('OK', 'NO', 'BAD') and self._match(imaplib.Response_code,
+                                                      dat):
+            typ = self.mo.group('type')
+            typ = str(typ, self._encoding)
+            self._append_untagged(typ, self.mo.group('data'))
+        return resp
+
+
+def run(cls, session, rounds):
+    best = None
+    for _ in range(rounds):
+        m = cls(session)
+        start = time.perf_counter()
+        count = m.replay()
+        cost = time.perf_counter() - start
+        if best is None or cost < best:
+            best = cost
+    #protocol lines are the responses plus one trailer per literal
+    for items in m.untagged_responses.values():
+        count += sum(1 for x in items if isinstance(x, tuple))
+    return count, best, m.untagged_responses
+
+
+def main():
+    p = argparse.ArgumentParser(description='imap response parser benchmark')
+    p.add_argument('--lines', type=int, default=100000)
+    p.add_argument('--record', help='record a session to this file and exit')
+    p.add_argument('--session', help='replay a session recorded before')
+    p.add_argument('--rounds', type=int, default=3)
+    p.add_argument('--trace',
+                   default='ring',
+                   choices=['off', 'ring'],
+                   help='trace sink while replaying')
+    args = p.parse_args()
+    if args.session:
+        with open(args.session, 'rb') as f:
+            session = f.read()
+    else:
+        session = record(args.lines)
+    if args.record:
+        with open(args.record, 'wb') as f:
+            f.write(session)
+        return
+    if args.trace == 'off':
+        imaplib.Trace = None
+    print('session of %.1f MB' % (len(session) / 1048576.0))
+    results = {}
+    for name, cls in (('regex', Legacy), ('dispatch', Replay)):
+        lines, cost, results[name] = run(cls, session, args.rounds)
+        print('%-8s %7d lines %6.3fs %9.0f lines/s' %
+              (name, lines, cost, lines / cost))
+    if results['regex'] != results['dispatch']:
+        print('parsers disagree')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
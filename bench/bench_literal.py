@@ -0,0 +1,97 @@
+#-*- coding:utf-8 -*-
+#peak memory of downloading one big message, bytes vs memoryview literals
+#usage: python bench/bench_literal.py [--size 50] [--spoolsize 1]
+#every mode runs in its own process so max rss is per mode
+import argparse
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH))
+sys.path.insert(0, BENCH)
+
+import fakeimap
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def serve(conn, size):
+    #server in another process, its copies of the body are not counted
+    s = fakeimap.FakeIMAPServer(
+        folders={'INBOX': fakeimap.Mailbox(1, size=size)}).start()
+    conn.send(s.address)
+    conn.recv()
+    s.stop()
+
+
+def child(address, mode, spoolsize):
+    import mail3
+    import imaplib
+    if mode == 'bytes':
+        #literal read as bytes and the old str(body).strip() check
+        imaplib._VIEW_SIZE = 0
+        mail3._blank = lambda body: str(body).strip() == ''
+    root = tempfile.mkdtemp()
+    m = mail3.Mailer(
+        root=root,
+        imap=address,
+        timeout=300,
+        spoolsize=spoolsize if mode == 'spool' else 0,
+        **{'user@example.com': 'p'})
+    tracemalloc.start()
+    start = time.time()
+    m.download()
+    cost = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    rss = 0
+    if resource is not None:
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    shutil.rmtree(root)
+    print('%-6s %6.2fs  traced peak %7.1f MB  max rss %7.1f MB' %
+          (mode, cost, peak / 1048576.0, rss))
+
+
+def main():
+    p = argparse.ArgumentParser(description='literal buffer benchmark')
+    p.add_argument('--size', type=int, default=50, help='message size in MB')
+    p.add_argument('--spoolsize',
+                   type=int,
+                   default=1,
+                   help='spool threshold in MB for the spool mode')
+    p.add_argument('--child', help=argparse.SUPPRESS)
+    p.add_argument('--address', help=argparse.SUPPRESS)
+    args = p.parse_args()
+    if args.child:
+        child(args.address, args.child, args.spoolsize * 1048576)
+        return
+    parent, conn = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve,
+                                     args=(conn, args.size * 1048576))
+    server.start()
+    address = parent.recv()
+    print('one %d MB message' % args.size)
+    try:
+        for mode in ('bytes', 'view', 'spool'):
+            subprocess.check_call([
+                sys.executable,
+                os.path.abspath(__file__), '--child', mode, '--address',
+                address, '--spoolsize',
+                str(args.spoolsize)
+            ])
+    finally:
+        parent.send(None)
+        server.join()
+
+
+if __name__ == '__main__':
+    main()
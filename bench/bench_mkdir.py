@@ -0,0 +1,65 @@
+#-*- coding:utf-8 -*-
+#count directory syscalls of Mailer._save with and without the dir cache
+#usage: python bench/bench_mkdir.py [--messages 20000] [--days 30]
+import argparse
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mail3
+
+CALLS = {}
+
+
+def counted(name, func):
+    def wrapper(*args, **kwargs):
+        CALLS[name] = CALLS.get(name, 0) + 1
+        return func(*args, **kwargs)
+
+    return wrapper
+
+
+def run(messages, days, cached):
+    root = tempfile.mkdtemp()
+    m = mail3.Mailer(root=root)
+    m.cache = {}
+    start_day = datetime.datetime(2017, 1, 1)
+    mail3._DIRS.clear()
+    mail3._HIDDEN.clear()
+    CALLS.clear()
+    start = time.time()
+    for i in range(messages):
+        if not cached:
+            mail3._DIRS.clear()
+            mail3._HIDDEN.clear()
+        _date = start_day + datetime.timedelta(days=i % days)
+        m._save('user@example.com', 'INBOX', _date, i, 'subject', b'x')
+        m._flush_meta()
+        m._append_summary('user@example.com/发件人', 'sender@example.com:1\n')
+    cost = time.time() - start
+    calls = dict(CALLS)
+    shutil.rmtree(root)
+    return cost, calls
+
+
+def main():
+    p = argparse.ArgumentParser(description='directory cache benchmark')
+    p.add_argument('--messages', type=int, default=20000)
+    p.add_argument('--days', type=int, default=30)
+    args = p.parse_args()
+    for name in ('stat', 'mkdir', 'makedirs'):
+        setattr(os, name, counted(name, getattr(os, name)))
+    for cached in (False, True):
+        cost, calls = run(args.messages, args.days, cached)
+        print('%-8s %.2fs %s' % ('cache' if cached else 'no cache', cost,
+                                 ' '.join('%s=%d' % kv
+                                          for kv in sorted(calls.items()))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#-*- coding:utf-8 -*-
+#full mime parse against the header only path used by Mailer._handle
+#usage: python bench/bench_parse.py [--corpus DIR_OF_EML] [--rounds 20]
+import argparse
+import base64
+import email
+import email.parser
+import glob
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mail3
+
+#typical sizes: plain text, html, office attachment, photos, big archive
+SIZES = [2 << 10, 30 << 10, 300 << 10, 3 << 20, 15 << 20]
+
+
+def make_eml(size):
+    head = ('From: =?utf-8?b?5byg5LiJ?= <sender@example.com>\r\n'
+            'To: a <a@example.com>, b <b@example.com>\r\n'
+            'Cc: c <c@example.com>\r\n'
+            'Subject: =?gb2312?b?suLK1A==?=\r\n'
+            'Date: Mon, 2 Jan 2017 10:00:00 +0800\r\n'
+            'MIME-Version: 1.0\r\n'
+            'Content-Type: multipart/mixed; boundary="b1"\r\n'
+            '\r\n'
+            '--b1\r\n'
+            'Content-Type: text/plain; charset=utf-8\r\n'
+            '\r\n'
+            'hello\r\n'
+            '--b1\r\n'
+            'Content-Type: application/octet-stream; name="a.bin"\r\n'
+            'Content-Transfer-Encoding: base64\r\n'
+            '\r\n').encode('ascii')
+    raw = os.urandom(max(0, (size - len(head)) * 3 // 4))
+    data = base64.encodebytes(raw).replace(b'\n', b'\r\n')
+    return head + data + b'--b1--\r\n'
+
+
+def bench(func, data, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(data)
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    p = argparse.ArgumentParser(description='header parse benchmark')
+    p.add_argument('--corpus', help='directory with .eml files')
+    p.add_argument('--rounds', type=int, default=20)
+    args = p.parse_args()
+    if args.corpus:
+        corpus = [(os.path.basename(f), open(f, 'rb').read())
+                  for f in glob.glob(os.path.join(args.corpus, '*.eml'))]
+    else:
+        corpus = [('%dKB' % (s >> 10), make_eml(s)) for s in SIZES]
+    m = mail3.Mailer(root=None)
+
+    def header(data):
+        return email.parser.BytesHeaderParser().parsebytes(m._head(data))
+
+    print('%-12s %12s %12s %8s' % ('message', 'full ms', 'header ms', 'gain'))
+    for label, data in corpus:
+        full = bench(email.message_from_bytes, data, args.rounds)
+        head = bench(header, data, args.rounds)
+        print('%-12s %12.3f %12.3f %7.0fx' % (label, full * 1000,
+                                             head * 1000, full / head))
+
+
+if __name__ == '__main__':
+    main()
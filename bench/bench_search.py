@@ -0,0 +1,80 @@
+#-*- coding:utf-8 -*-
+#full search + difference against uid n:* on a synthetic 2M uid folder,
+#with chunked SEARCH and with ESEARCH ranges, imaplib._MAXLINE untouched
+#usage: python bench/bench_search.py [--uids 2000000] [--new 10]
+#the server runs in its own process so the peak is the client's alone
+import argparse
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakeimap
+import mail3
+
+
+def serve(conn, count, capabilities):
+    s = fakeimap.FakeIMAPServer(folders={'INBOX': fakeimap.Mailbox(count)},
+                                capabilities=capabilities).start()
+    conn.send(s.address)
+    conn.recv()
+    s.stop()
+
+
+def run(address, synced, incremental):
+    root = tempfile.mkdtemp()
+    os.makedirs(root + '/.meta')
+    with open(root + '/.meta/user@example.com-INBOX.uids', 'w') as f:
+        f.write('V 1\nR 1 {0}\n'.format(synced))
+    mail3.asyncio.set_event_loop(mail3.asyncio.new_event_loop())
+    m = mail3.Mailer(
+        root=root,
+        imap=address,
+        incremental=incremental,
+        timeout=600,
+        **{'user@example.com': 'secret'})
+    tracemalloc.start()
+    start = time.time()
+    m.download()
+    cost = time.time() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    shutil.rmtree(root)
+    return cost, peak / 1048576.0
+
+
+def main():
+    p = argparse.ArgumentParser(description='search benchmark')
+    p.add_argument('--uids', type=int, default=2000000)
+    p.add_argument('--new', type=int, default=10)
+    args = p.parse_args()
+    results = []
+    for name, caps in (('chunked', [b'IMAP4rev1']),
+                       ('esearch', [b'IMAP4rev1', b'ESEARCH'])):
+        parent, conn = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=serve,
+                                         args=(conn, args.uids + args.new,
+                                               caps))
+        server.start()
+        address = parent.recv()
+        try:
+            for mode, incremental in (('full search', False), ('uid n:*',
+                                                                 True)):
+                cost, peak = run(address, args.uids, incremental)
+                results.append((name, mode, cost, peak))
+        finally:
+            parent.send(None)
+            server.join()
+    print('\nuids=%d new=%d' % (args.uids, args.new))
+    for name, mode, cost, peak in results:
+        print('%-8s %-12s %6.2fs  peak %6.1f MB' % (name, mode, cost, peak))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+#-*- coding:utf-8 -*-
+#minimal in-process imap server for benchmarks, not a real server
+import bisect
+import re
+import select
+import socketserver
+import threading
+import time
+
+MESSAGE = ('From: sender{uid} <sender{uid}@example.com>\r\n'
+           'To: rcpt <rcpt@example.com>\r\n'
+           'Cc: copy <copy@example.com>\r\n'
+           'Subject: message {uid}\r\n'
+           'Date: Mon, 2 Jan 2017 10:00:00 +0800\r\n'
+           'Message-ID: <{uid}@example.com>\r\n'
+           '\r\n')
+
+
+def make_message(uid, size=1024):
+    head = MESSAGE.format(uid=uid).encode('ascii')
+    line = b'x' * 74 + b'\r\n'
+    body = line * max(1, (size - len(head)) // len(line))
+    return head + body
+
+
+class Mailbox():
+    def __init__(self, count=0, size=1024, uidvalidity=1):
+        self.uids = list(range(1, count + 1))
+        self.size = size
+        self.uidvalidity = uidvalidity
+        self.modseq = count + 1
+
+    def append(self, count=1):
+        self.uids.extend(range(self.uidnext(), self.uidnext() + count))
+        self.modseq += count
+
+    def uidnext(self):
+        return self.uids[-1] + 1 if self.uids else 1
+
+    def body(self, uid):
+        return make_message(uid, self.size)
+
+    def envelope(self, uid):
+        return ('("Mon, 2 Jan 2017 10:00:00 +0800" "message {0}" '
+                '(("sender{0}" NIL "sender{0}" "example.com")) NIL NIL '
+                '(("rcpt" NIL "rcpt" "example.com")) '
+                '(("copy" NIL "copy" "example.com")) NIL NIL '
+                '"<{0}@example.com>")').format(uid).encode('ascii')
+
+
+def _tokens(line):
+    return re.findall(rb'"(?:[^"\\]|\\.)*"|\([^)]*\)|\S+', line)
+
+
+def _unquote(tok):
+    if tok.startswith(b'"'):
+        return tok[1:-1].replace(b'\\"', b'"').replace(b'\\\\', b'\\')
+    return tok
+
+
+def _parse_set(spec, uids, top=None):
+    #uids is sorted, every part is a bisect slice, * is top
+    if top is None:
+        top = uids[-1] if uids else 0
+    found = set()
+    for part in spec.split(b','):
+        a, _, b = part.partition(b':')
+        a = top if a == b'*' else int(a)
+        b = a if not b else (top if b == b'*' else int(b))
+        if a > b:
+            a, b = b, a
+        found.update(uids[bisect.bisect_left(uids, a):
+                          bisect.bisect_right(uids, b)])
+    return sorted(found)
+
+
+def _compact(uids):
+    #sorted uids to an imap set like 1:3,7
+    parts = []
+    for u in uids:
+        if parts and u == parts[-1][1] + 1:
+            parts[-1][1] = u
+        else:
+            parts.append([u, u])
+    return b','.join(('{0}:{1}'.format(a, b) if a != b else str(a)).encode(
+        'ascii') for a, b in parts)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        self.wfile.write(data)
+
+    def handle(self):
+        server = self.server
+        self.selected = None
+        self.send(b'* OK fake imap ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.rstrip(b'\r\n')
+            if not line:
+                continue
+            if server.latency:
+                time.sleep(server.latency)
+            tag, _, rest = line.partition(b' ')
+            cmd, _, args = rest.partition(b' ')
+            cmd = cmd.upper()
+            uid = False
+            if cmd == b'UID':
+                uid = True
+                cmd, _, args = args.partition(b' ')
+                cmd = cmd.upper()
+            with server.lock:
+                server.count[cmd] = server.count.get(cmd, 0) + 1
+            method = getattr(self, 'do_' + cmd.decode('ascii'), None)
+            if method is None:
+                self.send(tag + b' BAD unknown command\r\n')
+                continue
+            if method(tag, args, uid) is False:
+                return
+
+    def do_CAPABILITY(self, tag, args, uid):
+        self.send(b'* CAPABILITY ' + b' '.join(self.server.capabilities) +
+                  b'\r\n')
+        self.send(tag + b' OK CAPABILITY completed\r\n')
+
+    def do_LOGIN(self, tag, args, uid):
+        user = _unquote(_tokens(args)[0]).decode('utf-8')
+        if user in self.server.deny:
+            self.send(tag + b' NO [AUTHENTICATIONFAILED] LOGIN failed\r\n')
+            return
+        self.user = user
+        self.send(tag + b' OK LOGIN completed\r\n')
+
+    def do_NOOP(self, tag, args, uid):
+        self.send(tag + b' OK NOOP completed\r\n')
+
+    def do_IDLE(self, tag, args, uid):
+        #report EXISTS when the selected mailbox grows, until DONE
+        box = self.selected
+        known = len(box.uids)
+        self.send(b'+ idling\r\n')
+        while True:
+            ready, _, _ = select.select([self.connection], [], [], 0.05)
+            if ready:
+                line = self.rfile.readline()
+                if not line:
+                    return False
+                if line.strip().upper() == b'DONE':
+                    self.send(tag + b' OK IDLE terminated\r\n')
+                    return
+                continue
+            if len(box.uids) != known:
+                known = len(box.uids)
+                self.send(('* {0} EXISTS\r\n'.format(known)).encode('ascii'))
+
+    def do_LOGOUT(self, tag, args, uid):
+        self.send(b'* BYE bye\r\n' + tag + b' OK LOGOUT completed\r\n')
+        return False
+
+    def do_LIST(self, tag, args, uid):
+        for name in self.server.folders:
+            self.send(b'* LIST (\\HasNoChildren) "/" "' +
+                      name.encode('utf-8') + b'"\r\n')
+        self.send(tag + b' OK LIST completed\r\n')
+
+    def do_SELECT(self, tag, args, uid):
+        name = _unquote(_tokens(args)[0]).decode('utf-8')
+        box = self.server.folders.get(name)
+        if box is None:
+            self.send(tag + b' NO no such mailbox\r\n')
+            return
+        self.selected = box
+        self.send(('* FLAGS (\\Seen)\r\n'
+                   '* {0} EXISTS\r\n'
+                   '* 0 RECENT\r\n'
+                   '* OK [UIDVALIDITY {1}] ok\r\n'
+                   '* OK [UIDNEXT {2}] ok\r\n').format(
+                       len(box.uids), box.uidvalidity,
+                       box.uidnext()).encode('ascii'))
+        self.send(tag + b' OK [READ-WRITE] SELECT completed\r\n')
+
+    do_EXAMINE = do_SELECT
+
+    def do_STATUS(self, tag, args, uid):
+        toks = _tokens(args)
+        name = _unquote(toks[0]).decode('utf-8')
+        box = self.server.folders.get(name)
+        if box is None:
+            self.send(tag + b' NO no such mailbox\r\n')
+            return
+        values = {
+            b'MESSAGES': len(box.uids),
+            b'UIDNEXT': box.uidnext(),
+            b'UIDVALIDITY': box.uidvalidity,
+            b'HIGHESTMODSEQ': box.modseq,
+            b'RECENT': 0,
+            b'UNSEEN': 0
+        }
+        items = [
+            k + b' ' + str(values[k]).encode('ascii')
+            for k in toks[1].strip(b'()').upper().split()
+        ]
+        self.send(b'* STATUS ' + toks[0] + b' (' + b' '.join(items) +
+                  b')\r\n')
+        self.send(tag + b' OK STATUS completed\r\n')
+
+    def do_SEARCH(self, tag, args, uid):
+        box = self.selected
+        toks = _tokens(args.upper())
+        esearch = toks[:1] == [b'RETURN']
+        if esearch:
+            if b'ESEARCH' not in self.server.capabilities:
+                self.send(tag + b' BAD unknown search key\r\n')
+                return
+            toks = toks[2:]
+        #criteria are ANDed: ALL, UID set or a message sequence set
+        found = box.uids
+        top = box.uids[-1] if box.uids else 0
+        i = 0
+        while i < len(toks):
+            if toks[i] == b'UID' and i + 1 < len(toks):
+                found = _parse_set(toks[i + 1], found, top)
+                i += 1
+            elif toks[i][:1].isdigit() or toks[i][:1] == b'*':
+                seqs = _parse_set(toks[i], range(1, len(box.uids) + 1))
+                picked = [box.uids[s - 1] for s in seqs]
+                if found is not box.uids:
+                    keep = set(found)
+                    picked = [u for u in picked if u in keep]
+                found = picked
+            i += 1
+        if esearch:
+            out = b'* ESEARCH (TAG "' + tag + b'") UID'
+            if found:
+                out += b' ALL ' + _compact(found)
+            self.send(out + b'\r\n')
+        else:
+            self.send(b'* SEARCH ' + b' '.join(str(u).encode('ascii')
+                                               for u in found) + b'\r\n')
+        self.send(tag + b' OK SEARCH completed\r\n')
+
+    def do_FETCH(self, tag, args, uid):
+        box = self.selected
+        server = self.server
+        if server.autologout:
+            #every nth fetch the session is dropped like a server timeout
+            with server.lock:
+                server.fetches += 1
+                drop = server.fetches % server.autologout == 0
+            if drop:
+                self.send(b'* BYE Autologout; idle for too long\r\n')
+                return False
+        spec, _, items = args.partition(b' ')
+        items = items.upper()
+        for u in _parse_set(spec, box.uids):
+            seq = bisect.bisect_left(box.uids, u) + 1
+            out = ('* {0} FETCH (UID {1}'.format(seq, u)).encode('ascii')
+            if b'ENVELOPE' in items:
+                out += b' ENVELOPE ' + box.envelope(u)
+            if b'RFC822.SIZE' in items:
+                out += (' RFC822.SIZE {0}'.format(len(box.body(u)))).encode(
+                    'ascii')
+            if b'INTERNALDATE' in items:
+                out += b' INTERNALDATE "02-Jan-2017 10:00:00 +0800"'
+            if b'BODY' in items and b'BODY[]' in items.replace(b'.PEEK', b''):
+                data = box.body(u)
+                out += (' BODY[] {{{0}}}\r\n'.format(len(data))).encode(
+                    'ascii') + data
+            self.send(out + b')\r\n')
+        self.send(tag + b' OK FETCH completed\r\n')
+
+
+class FakeIMAPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self,
+                 folders=None,
+                 latency=0.0,
+                 deny=(),
+                 capabilities=None,
+                 autologout=0):
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), Handler)
+        self.folders = folders if folders is not None else {
+            'INBOX': Mailbox(10)
+        }
+        self.latency = latency
+        self.deny = set(deny)
+        self.capabilities = capabilities or [b'IMAP4rev1']
+        self.thread = None
+        self.lock = threading.Lock()
+        self.count = {}
+        self.autologout = autologout
+        self.fetches = 0
+
+    @property
+    def address(self):
+        return '{0}:{1}'.format(*self.server_address)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
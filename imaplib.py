@@ -3,7 +3,11 @@
 Based on RFC 2060.
 
 Public class:           IMAP4
+                        Spool
+                        RingTrace
+                        FileTrace
 Public variable:        Debug
+                        Trace
 Public functions:       Internaldate2tuple
                         Int2AP
                         ParseFlags
@@ -22,7 +26,7 @@ Public functions:       Internaldate2tuple
 
 __version__ = "2.58"
 
-import binascii, errno, random, re, socket, subprocess, sys, time, calendar
+import binascii, errno, random, re, socket, subprocess, sys, tempfile, threading, time, calendar
 from datetime import datetime, timezone, timedelta
 from io import DEFAULT_BUFFER_SIZE
 
@@ -33,8 +37,8 @@ except ImportError:
     HAVE_SSL = False
 
 __all__ = [
-    "IMAP4", "IMAP4_stream", "Internaldate2tuple", "Int2AP", "ParseFlags",
-    "Time2Internaldate"
+    "IMAP4", "IMAP4_stream", "FileTrace", "Internaldate2tuple", "Int2AP",
+    "ParseFlags", "RingTrace", "Spool", "Time2Internaldate"
 ]
 
 #       Globals
@@ -55,6 +59,23 @@ AllowedVersions = ('IMAP4REV1', 'IMAP4')  # Most recent first
 _MAXLINE = 1000000
 _FORCE_HEADER = False
 
+# Literals larger than this many bytes are streamed into a Spool instead
+# of being returned as bytes, so a FETCH of big messages does not have to
+# sit in memory. 0 disables spooling.
+_SPOOL_SIZE = 0
+_SPOOL_CHUNK = 0x10000
+
+# Literals of at least this many bytes are read with readinto() into one
+# preallocated buffer and returned as a memoryview, so slicing them later
+# copies nothing. Smaller ones (envelope strings, folder names) stay bytes
+# for parsers that decode them. 0 disables views.
+_VIEW_SIZE = 0x10000
+
+# Lines sent and received are handed to a trace sink made per connection
+# by calling Trace(), see RingTrace and FileTrace. None turns tracing off.
+# Sinks keep the raw lines, formatting happens only when they are shown.
+Trace = None  # set to RingTrace below
+
 #       Commands
 
 Commands = {
@@ -129,6 +150,8 @@ Untagged_status = re.compile(
     br'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?', re.ASCII)
 # We compile these in _mode_xxx.
 _Literal = br'.*{(?P<size>\d+)}$'
+# Characters of a response type, '* TYPE' and '* n TYPE' are split by hand.
+_TYPE_CHARS = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ-'
 _Untagged_status = br'\* (?P<data>\d+) (?P<type>[A-Z-]+)( (?P<data2>.*))?'
 
 
@@ -195,6 +218,8 @@ class IMAP4:
         self.continuation_response = ''  # Last continuation response
         self.is_readonly = False  # READ-ONLY desired state
         self.tagnum = 0
+        self.spool_size = _SPOOL_SIZE  # Spool literals above this size
+        self.view_size = _VIEW_SIZE  # memoryview literals from this size
         self._tls_established = False
         self._mode_ascii()
 
@@ -241,9 +266,7 @@ class IMAP4:
         # request and store CAPABILITY response.
 
         if __debug__:
-            self._cmd_log_len = 10
-            self._cmd_log_idx = 0
-            self._cmd_log = {}  # Last `_cmd_log_len' interactions
+            self._trace = Trace() if Trace is not None else None
             if self.debug >= 1:
                 self._mesg('imaplib version %s' % __version__)
                 self._mesg('new IMAP4 connection, tag=%s' % self.tagpre)
@@ -304,6 +327,10 @@ class IMAP4:
         """Read 'size' bytes from remote."""
         return self.file.read(size)
 
+    def readinto(self, buf):
+        """Read up to len(buf) bytes from remote into 'buf'."""
+        return self.file.readinto(buf)
+
     def readline(self):
         """Read line from remote."""
         line = self.file.readline(_MAXLINE + 1)
@@ -932,8 +959,8 @@ class IMAP4:
         if __debug__:
             if self.debug >= 4:
                 self._mesg('> %r' % data)
-            else:
-                self._log('> %r' % data)
+            elif self._trace is not None:
+                self._trace.add('>', data)
 
         try:
             self.send(data + CRLF)
@@ -1000,55 +1027,27 @@ class IMAP4:
         #
         # Returns None for continuation responses,
         # otherwise first response line received.
+        #
+        # Lines are dispatched on their first byte: '*' untagged, '+'
+        # continuation, anything else must carry our tag.
 
         resp = self._get_line()
+        first = resp[:1]
 
-        # Command completion response?
-
-        if self._match(self.tagre, resp):
-            tag = self.mo.group('tag')
-            if not tag in self.tagged_commands:
-                raise self.abort('unexpected tagged response: %r' % resp)
-
-            typ = self.mo.group('type')
-            typ = str(typ, self._encoding)
-            dat = self.mo.group('data')
-            self.tagged_commands[tag] = (typ, [dat])
-        else:
-            dat2 = None
-
-            # '*' (untagged) responses?
-
-            if not self._match(Untagged_response, resp):
-                if self._match(self.Untagged_status, resp):
-                    dat2 = self.mo.group('data2')
-
-            if self.mo is None:
-                # Only other possibility is '+' (continuation) response...
-
-                if self._match(Continuation, resp):
-                    self.continuation_response = self.mo.group('data')
-                    return None  # NB: indicates continuation
-
-                raise self.abort("unexpected response: %r" % resp)
-
-            typ = self.mo.group('type')
-            typ = str(typ, self._encoding)
-            dat = self.mo.group('data')
-            if dat is None: dat = b''  # Null untagged response
-            if dat2: dat = dat + b' ' + dat2
+        if first == b'*':
+            typ, dat = self._parse_untagged(resp)
 
             # Is there a literal to come?
 
-            while self._match(self.Literal, dat):
+            size = _literal_size(dat)
+            while size is not None:
 
                 # Read literal direct from connection.
 
-                size = int(self.mo.group('size'))
                 if __debug__:
                     if self.debug >= 4:
                         self._mesg('read literal size %s' % size)
-                data = self.read(size)
+                data = self._read_literal(size)
 
                 # Store response with literal as tuple
 
@@ -1057,12 +1056,34 @@ class IMAP4:
                 # Read trailer - possibly containing another literal
 
                 dat = self._get_line()
+                size = _literal_size(dat)
 
             self._append_untagged(typ, dat)
 
+        elif first == b'+':
+            self.continuation_response = resp[2:] if resp[1:2] == b' ' \
+                else None
+            return None  # NB: indicates continuation
+
+        else:
+
+            # Command completion response?
+
+            if not self._match(self.tagre, resp):
+                raise self.abort("unexpected response: %r" % resp)
+            tag = self.mo.group('tag')
+            if not tag in self.tagged_commands:
+                raise self.abort('unexpected tagged response: %r' % resp)
+
+            typ = self.mo.group('type')
+            typ = str(typ, self._encoding)
+            dat = self.mo.group('data')
+            self.tagged_commands[tag] = (typ, [dat])
+
         # Bracketed response information?
 
-        if typ in ('OK', 'NO', 'BAD') and self._match(Response_code, dat):
+        if typ in ('OK', 'NO', 'BAD') and dat[:1] == b'[' and \
+                self._match(Response_code, dat):
             typ = self.mo.group('type')
             typ = str(typ, self._encoding)
             self._append_untagged(typ, self.mo.group('data'))
@@ -1073,6 +1094,76 @@ class IMAP4:
 
         return resp
 
+    def _parse_untagged(self, resp):
+
+        # Split '* TYPE data' and '* n TYPE data' (FETCH, EXISTS, ...) by
+        # hand, anything unusual goes through the regular expressions.
+
+        if resp[1:2] == b' ':
+            sp = resp.find(b' ', 2)
+            word = resp[2:] if sp < 0 else resp[2:sp]
+            if word.isdigit():
+                if sp > 0:
+                    sp2 = resp.find(b' ', sp + 1)
+                    typ = resp[sp + 1:] if sp2 < 0 else resp[sp + 1:sp2]
+                    if typ and not typ.strip(_TYPE_CHARS):
+                        rest = b'' if sp2 < 0 else resp[sp2 + 1:]
+                        if rest:
+                            word = word + b' ' + rest
+                        return str(typ, self._encoding), word
+            elif word and not word.strip(_TYPE_CHARS):
+                return str(word, self._encoding), \
+                    b'' if sp < 0 else resp[sp + 1:]
+
+        dat2 = None
+        if not self._match(Untagged_response, resp):
+            if self._match(self.Untagged_status, resp):
+                dat2 = self.mo.group('data2')
+        if self.mo is None:
+            raise self.abort("unexpected response: %r" % resp)
+
+        typ = self.mo.group('type')
+        typ = str(typ, self._encoding)
+        dat = self.mo.group('data')
+        if dat is None: dat = b''  # Null untagged response
+        if dat2: dat = dat + b' ' + dat2
+        return typ, dat
+
+    def _read_literal(self, size):
+
+        # Small literals (or spooling disabled) are read in one go,
+        # big ones are copied chunk by chunk into a Spool.
+
+        if not self.spool_size or size <= self.spool_size:
+            if not self.view_size or size < self.view_size:
+                return self.read(size)
+            return self._read_view(size)
+        spool = Spool(self.spool_size)
+        left = size
+        while left > 0:
+            chunk = self.read(min(left, _SPOOL_CHUNK))
+            if not chunk:
+                spool.close()
+                raise self.abort('socket error: EOF')
+            spool.write(chunk)
+            left -= len(chunk)
+        spool.seek(0)
+        return spool
+
+    def _read_view(self, size):
+
+        # Fill one buffer in place, the socket data is copied exactly once.
+
+        buf = bytearray(size)
+        view = memoryview(buf)
+        got = 0
+        while got < size:
+            n = self.readinto(view[got:])
+            if not n:
+                raise self.abort('socket error: EOF')
+            got += n
+        return view
+
     def _get_tagged_response(self, tag):
 
         while 1:
@@ -1113,8 +1204,8 @@ class IMAP4:
         if __debug__:
             if self.debug >= 4:
                 self._mesg('< %r' % line)
-            else:
-                self._log('< %r' % line)
+            elif self._trace is not None:
+                self._trace.add('<', line)
         return line
 
     def _match(self, cre, s):
@@ -1177,25 +1268,11 @@ class IMAP4:
                 l)
             self._mesg('untagged responses dump:%s%s' % (t, t.join(l)))
 
-        def _log(self, line):
-            # Keep log of last `_cmd_log_len' interactions for debugging.
-            self._cmd_log[self._cmd_log_idx] = (line, time.time())
-            self._cmd_log_idx += 1
-            if self._cmd_log_idx >= self._cmd_log_len:
-                self._cmd_log_idx = 0
-
         def print_log(self):
-            self._mesg('last %d IMAP4 interactions:' % len(self._cmd_log))
-            i, n = self._cmd_log_idx, self._cmd_log_len
-            while n:
-                try:
-                    self._mesg(*self._cmd_log[i])
-                except:
-                    pass
-                i += 1
-                if i >= self._cmd_log_len:
-                    i = 0
-                n -= 1
+            if self._trace is None:
+                self._mesg('IMAP4 tracing is off')
+            else:
+                self._trace.dump(self._mesg)
 
 
 if HAVE_SSL:
@@ -1297,6 +1374,10 @@ class IMAP4_stream(IMAP4):
         """Read 'size' bytes from remote."""
         return self.readfile.read(size)
 
+    def readinto(self, buf):
+        """Read up to len(buf) bytes from remote into 'buf'."""
+        return self.readfile.readinto(buf)
+
     def readline(self):
         """Read line from remote."""
         return self.readfile.readline()
@@ -1313,6 +1394,103 @@ class IMAP4_stream(IMAP4):
         self.process.wait()
 
 
+class Spool:
+    """File-like holder for a literal streamed off the connection.
+
+    Instantiate with: Spool(max_size)
+
+            max_size - bytes kept in memory before rolling over to a
+                       temporary file.
+
+    len() gives the literal size so it can stand in for bytes where
+    only the length is checked; read() and seek() behave like a file.
+    """
+
+    def __init__(self, max_size):
+        self.file = tempfile.SpooledTemporaryFile(max_size=max_size)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def write(self, data):
+        self.file.write(data)
+        self.size += len(data)
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def seek(self, offset, whence=0):
+        return self.file.seek(offset, whence)
+
+    def close(self):
+        self.file.close()
+
+
+class RingTrace:
+    """Trace sink keeping the last lines of one connection.
+
+    Instantiate with: RingTrace(size=10)
+
+            size - number of lines kept, older ones are dropped.
+
+    Lines are stored as received; they are only formatted when
+    dump() shows them, which print_log() does on abort.
+    """
+
+    def __init__(self, size=10):
+        self.size = size
+        self.lines = [None] * size
+        self.idx = 0
+
+    def add(self, direction, line):
+        self.lines[self.idx] = (direction, line, time.time())
+        self.idx += 1
+        if self.idx >= self.size:
+            self.idx = 0
+
+    def dump(self, mesg):
+        lines = [x for x in self.lines[self.idx:] + self.lines[:self.idx] if x]
+        mesg('last %d IMAP4 interactions:' % len(lines))
+        for direction, line, secs in lines:
+            mesg('%s %r' % (direction, line), secs)
+
+
+class FileTrace:
+    """Trace sink appending every line to a file.
+
+    Instantiate with: FileTrace(path)
+
+    One instance is shared by all connections: it returns itself
+    when called, so it can be assigned to Trace directly.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'a', encoding='ascii', buffering=1)
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        return self
+
+    def add(self, direction, line):
+        secs = time.time()
+        tm = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(secs))
+        with self.lock:
+            self.file.write('%s.%02d %s %s %r\n' %
+                            (tm, (secs * 100) % 100,
+                             threading.current_thread().name, direction, line))
+
+    def dump(self, mesg):
+        mesg('IMAP4 trace is in %s' % self.path)
+
+    def close(self):
+        self.file.close()
+
+
+Trace = RingTrace
+
+
 class _Authenticator:
     """Private class to provide en/decoding
             for base64-based authentication conversation.
@@ -1407,6 +1585,18 @@ def Int2AP(num):
     return val
 
 
+def _literal_size(dat):
+    """Size of the literal announced at the end of 'dat', else None."""
+
+    if dat[-1:] != b'}':
+        return None
+    i = dat.rfind(b'{')
+    size = dat[i + 1:-1]
+    if i < 0 or not size.isdigit():
+        return None
+    return int(size)
+
+
 def _Int2AP():
     return b'F'
 
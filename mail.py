@@ -9,6 +9,9 @@ import logging
 import argparse
 import ConfigParser
 import sys
+import errno
+import threading
+import socket
 from imapclient import IMAPClient
 from multiprocessing.pool import ThreadPool
 
@@ -25,6 +28,20 @@ logger.addHandler(ch)
 #for windows hidden attr
 FILE_ATTRIBUTE_HIDDEN = 0x02
 PATH_SPECIAL_CHARS = ['<', '>', ':', '"', '/', '\\', '|', '?', '*']
+#directories known to exist and paths already hidden, shared by every
+#worker in the process, set add/lookup are atomic under the GIL
+_DIRS = set()
+_HIDDEN = set()
+#logins in a row for one folder without progress before it is given up
+RELOGIN = 3
+
+
+def _disconnected(e):
+    #session level failures, a new login and the same folder fix them
+    if isinstance(e, (IMAPClient.AbortError, socket.error)):
+        return True
+    text = str(e)
+    return 'Autologout' in text or 'BYE' in text
 
 
 def _fix_name(filename):
@@ -34,6 +51,30 @@ def _fix_name(filename):
     return fix
 
 
+class TokenBucket():
+    #thread safe, reserve returns the seconds to wait before going on
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            #negative tokens book a slot in the future
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
 class Mailer():
     def __init__(self,
                  root=None,
@@ -41,6 +82,7 @@ class Mailer():
                  ssl=False,
                  groups=None,
                  poolsize=0x0a,
+                 loginrate=0,
                  pagesize=0x64,
                  timeout=None,
                  **users):
@@ -56,31 +98,38 @@ class Mailer():
         self.timeout = timeout
         #the max size is 10
         self.tp = ThreadPool(poolsize)
+        #logins per second per imap host, 0 means no limit
+        self.loginrate = loginrate
+        self.buckets = {}
+        self.failed_lock = threading.Lock()
         #don,t use lock
         self.summary = {}
 
-    def _list_all_clients(self):
+    def _parse_imap(self):
         hosts = self.imap.split(':')
         self.host = hosts[0]
         if len(hosts) >= 2:
             self.port = hosts[1]
-        cache = {}
-        for u, p in self.users.items():
-            try:
-                conn = IMAPClient(
-                    self.host,
-                    port=self.port,
-                    ssl=self.ssl,
-                    use_uid=True,
-                    timeout=self.timeout)
-                conn.login(u, p)
-                cache[u] = conn
-            except Exception as e:
-                logger.error('create imap client failed %s', e)
-                if 'LOGIN' in e.message:
-                    self._save_login_failed(u, p)
-        #return all clients
-        return cache
+        self.buckets[self.host] = TokenBucket(
+            self.loginrate, burst=int(self.loginrate))
+
+    def _login(self, u, p):
+        #pace the handshakes, each worker books its own slot
+        time.sleep(self.buckets[self.host].reserve())
+        try:
+            conn = IMAPClient(
+                self.host,
+                port=self.port,
+                ssl=self.ssl,
+                use_uid=True,
+                timeout=self.timeout)
+            conn.login(u, p)
+            return conn
+        except Exception as e:
+            logger.error('create imap client failed %s', e)
+            if 'LOGIN' in e.message:
+                self._save_login_failed(u, p)
+        return None
 
     def _list_mailbox(self, conn):
         mailboxes = []
@@ -180,25 +229,57 @@ class Mailer():
 
     def download(self):
         self.cache = self._load_meta()
-        clients = self._list_all_clients()
+        self._parse_imap()
         handlers = []
-        for u, c in clients.items():
-            #self._wrap_download(c,u)
+        for u, p in self.users.items():
+            #login and download in one task, no wait for other logins
             handlers.append(
-                self.tp.apply_async(self._wrap_download, args=(c, u)))
+                self.tp.apply_async(self._wrap_download, args=(u, p)))
         #wait for ok
         for h in handlers:
             h.get()
         self._flush_meta()
 
-    def _wrap_download(self, c, u):
+    def _wrap_download(self, u, p):
+        c = self._login(u, p)
+        if c is None:
+            return
         try:
             boxes = self._list_mailbox(c)
             for b in boxes:
-                self._download(u, b, c)
+                c = self._download_folder(u, p, b, c)
+                if c is None:
+                    return
         except Exception as e:
             logger.error('handle error message %s', e)
 
+    def _download_folder(self, u, p, name, c):
+        #a lost session is logged in again and the folder resumed, uids
+        #already in the meta are not fetched twice
+        _key = u'{0}-{1}'.format(u, name)
+        attempt = 0
+        while True:
+            before = len(self.cache.get(_key, ()))
+            try:
+                self._download(u, name, c)
+                return c
+            except Exception as e:
+                if len(self.cache.get(_key, ())) != before:
+                    #pages were saved, only failures in a row count
+                    attempt = 0
+                attempt += 1
+                if attempt > RELOGIN or not _disconnected(e):
+                    raise
+                logger.info('Email(%s[%s]) session lost: %s, login again', u,
+                            name, e)
+                try:
+                    c.logout()
+                except Exception:
+                    pass
+                c = self._login(u, p)
+                if c is None:
+                    return None
+
     def _save(self, user, mbox, _date, uid, subject, data):
         self._mkdir(self.root, mode=0777)
         p = u'{0}/email/{1}/{2}/{3}'.format(self.root, self._get_dir(user),
@@ -213,6 +294,8 @@ class Mailer():
             #full path
             logger.error('write file failed ,path is %s,id is %s ,error:%s', p,
                          uid, e)
+            #directory may be gone since it was cached
+            _DIRS.discard(p)
             #save again
             self._save(user, mbox, _date, uid, 'InvalidFile', data)
 
@@ -220,17 +303,19 @@ class Mailer():
         _pp = u'{0}/summary/登陆失败'.format(self.root)
         self._mkdir(_pp)
         try:
-            _list = set()
-            if os.path.exists(u'{0}/content.txt'.format(_pp)):
-                with open(u'{0}/content.txt'.format(_pp), 'r+') as f:
-                    for line in f.readlines():
-                        _list.add(line)
-            if _list.__contains__('{0}:{1}'.format(user, password)):
-                return
-            _list.add(u'{0}:{1}'.format(user, password))
-            with open(u'{0}/content.txt'.format(_pp), 'w+') as f:
-                f.write('\n'.join(_list))
-                f.flush()
+            #logins run concurrently, file is rewritten as a whole
+            with self.failed_lock:
+                _list = set()
+                if os.path.exists(u'{0}/content.txt'.format(_pp)):
+                    with open(u'{0}/content.txt'.format(_pp), 'r+') as f:
+                        for line in f.readlines():
+                            _list.add(line)
+                if _list.__contains__('{0}:{1}'.format(user, password)):
+                    return
+                _list.add(u'{0}:{1}'.format(user, password))
+                with open(u'{0}/content.txt'.format(_pp), 'w+') as f:
+                    f.write('\n'.join(_list))
+                    f.flush()
         except Exception as e:
             logger.error('save file error %s', e.message)
 
@@ -329,6 +414,9 @@ class Mailer():
             record[uu] += 1
 
     def _hidden(self, path):
+        if path in _HIDDEN:
+            return
+        _HIDDEN.add(path)
         if os.name == 'nt':
             import ctypes
             ret = ctypes.windll.kernel32.SetFileAttributesW(
@@ -340,9 +428,22 @@ class Mailer():
             logger.debug('os is unix like system, do nothing')
 
     def _mkdir(self, path, mode=0777):
-        if os.path.exists(path):
+        if path in _DIRS:
             return
-        os.makedirs(path, mode)
+        #one mkdir when the parent exists, makedirs only for new trees
+        try:
+            os.mkdir(path, mode)
+        except OSError as e:
+            if e.errno == errno.ENOENT:
+                try:
+                    os.makedirs(path, mode)
+                except OSError as e:
+                    #other workers may create the same parent
+                    if e.errno != errno.EEXIST:
+                        raise
+            elif e.errno != errno.EEXIST:
+                raise
+        _DIRS.add(path)
 
     def _get_dir(self, user):
         if self.groups is None:
@@ -423,6 +524,8 @@ if __name__ == '__main__':
         groups=mapping,
         pagesize=pagesize,
         poolsize=poolsize,
+        loginrate=ini.getfloat('mailer', 'loginrate')
+        if ini.has_option('mailer', 'loginrate') else 0,
         timeout=3000 if ini.getint('mailer', 'timeout') == 0 else ini.getint(
             'mailer', 'timeout'),
         **users)
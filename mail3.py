@@ -3,14 +3,28 @@
 import os
 import email
 import email.header
+import email.parser
 import datetime
 import time
 import logging
 import argparse
 import configparser
 import sys
+import shutil
+import hashlib
+import zlib
+import gzip
+import bisect
+from array import array
 from imapclient import IMAPClient
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import threading
+import socket
+import signal
+import queue
 import asyncio
+import multiprocessing
 import imaplib
 
 logger = logging.getLogger('mailer')
@@ -26,6 +40,37 @@ logger.addHandler(ch)
 #for windows hidden attr
 FILE_ATTRIBUTE_HIDDEN = 0x02
 PATH_SPECIAL_CHARS = ['<', '>', ':', '"', '/', '\\', '|', '?', '*']
+#more holes than this in the watermark and a full search is cheaper
+MAX_SEARCH_GAPS = 0x100
+#messages per SEARCH on servers without ESEARCH, keeps each reply line
+#well below imaplib._MAXLINE
+SEARCH_CHUNK = 0x8000
+#adaptive pacing, delay bounds in seconds and retries on throttling
+PACE_MIN = 0.05
+PACE_MAX = 30
+PACE_RETRY = 3
+#fetch latency per byte above baseline * this counts as push back, every
+#message counts PACE_OVERHEAD bytes on top of its body so envelope pages
+#and pages of big attachments compare
+LATENCY_FACTOR = 3
+PACE_OVERHEAD = 0x1000
+#directories known to exist and paths already hidden, shared by every
+#worker in the process, set add/lookup are atomic under the GIL
+_DIRS = set()
+_HIDDEN = set()
+#rotate segment files at this size
+SEGMENT_SIZE = 0x10000000
+#logins in a row for one folder without progress before it is given up
+RELOGIN = 3
+#re-issue IDLE before servers drop it (rfc 2177 says 29 minutes), look
+#for stop every IDLE_CHECK seconds and wait IDLE_RETRY after a failure,
+#doubled on every failure in a row up to IDLE_BACKOFF
+IDLE_RENEW = 25 * 60
+IDLE_CHECK = 30
+IDLE_RETRY = 30
+IDLE_BACKOFF = 30 * 60
+THROTTLE_TEXT = ('THROTTL', 'TOO MANY', 'RATE LIMIT', 'TRY AGAIN', 'LIMIT]',
+                 'UNAVAILABLE]', 'INUSE]', 'SERVERBUG]')
 
 
 def _fix_name(filename):
@@ -35,14 +80,857 @@ def _fix_name(filename):
     return fix
 
 
+def _disconnected(e):
+    #session level failures, a new login and the same folder fix them
+    if isinstance(e, (imaplib.IMAP4.abort, ConnectionError, socket.timeout)):
+        return True
+    text = str(e)
+    return 'Autologout' in text or 'BYE' in text
+
+
+def _imap_mesg(s, secs=None):
+    #imaplib debug output, print_log passes the time the line was traced
+    if secs is None:
+        logger.debug('imap %s', s)
+    else:
+        logger.debug('imap %s %s',
+                     time.strftime('%H:%M:%S', time.localtime(secs)), s)
+
+
+def _quiet(conn):
+    #imapclient sets imaplib debug to 5, which formats every line for its
+    #logger even when nothing shows it; leave lines to the trace sink then
+    if not logging.getLogger('imapclient.imaplib').isEnabledFor(
+            logging.DEBUG):
+        conn._imap.debug = 0
+        conn._imap._mesg = _imap_mesg
+
+
+def _condstore(conn):
+    return conn.has_capability('CONDSTORE') or conn.has_capability('QRESYNC')
+
+
+def _logout(conn):
+    try:
+        conn.logout()
+    except Exception as e:
+        logger.debug('logout failed %s', e)
+
+
+class SessionPool():
+    #logged in sessions by (host, user), idle ones get a NOOP every
+    #keepalive seconds so the server does not drop them between uses,
+    #past limit idle ones on a host the oldest is logged out
+    def __init__(self, keepalive=0, limit=0):
+        self.keepalive = keepalive
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.stopped = threading.Event()
+        self.thread = None
+        if keepalive > 0:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def get(self, host, user):
+        with self.lock:
+            sessions = self.idle.get((host, user))
+            if not sessions:
+                return None
+            conn, _ = sessions.pop()
+        return conn
+
+    def put(self, host, user, conn):
+        with self.lock:
+            self.idle.setdefault((host, user), []).append((conn, time.time()))
+            evicted = self._evict(host)
+        for old in evicted:
+            _logout(old)
+
+    def _evict(self, host):
+        if self.limit <= 0:
+            return []
+        sessions = sorted(((t, key, c) for key, v in self.idle.items()
+                           for c, t in v if key[0] == host),
+                          key=lambda x: x[0])
+        evicted = []
+        for t, key, c in sessions[:max(0, len(sessions) - self.limit)]:
+            self.idle[key] = [x for x in self.idle[key] if x[0] is not c]
+            if not self.idle[key]:
+                del self.idle[key]
+            evicted.append(c)
+        return evicted
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        with self.lock:
+            sessions = [c for v in self.idle.values() for c, _ in v]
+            self.idle = {}
+        for conn in sessions:
+            _logout(conn)
+
+    def _run(self):
+        while not self.stopped.wait(self.keepalive):
+            self._ping()
+
+    def _ping(self):
+        now = time.time()
+        due = []
+        with self.lock:
+            for key, sessions in list(self.idle.items()):
+                due.extend((key, c) for c, t in sessions
+                           if now - t >= self.keepalive)
+                self.idle[key] = [(c, t) for c, t in sessions
+                                  if now - t < self.keepalive]
+        for key, conn in due:
+            #out of the pool while pinged, nobody else can use it
+            try:
+                conn.noop()
+            except Exception as e:
+                logger.info('drop idle session of %s: %s', key[1], e)
+                _logout(conn)
+                continue
+            self.put(key[0], key[1], conn)
+
+
+class TokenBucket():
+    #thread safe, reserve returns the seconds to wait before going on
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def reserve(self, count=1):
+        if self.rate <= 0:
+            return 0
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            #negative tokens book a slot in the future
+            self.tokens -= count
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+
+class Pacer():
+    #per host pacing, only slows down when the server pushes back
+    def __init__(self, rate=0, burst=1):
+        #hard ceiling in messages per second, 0 means none
+        self.bucket = TokenBucket(rate, burst)
+        self.delay = 0.0
+        self.baseline = None
+        self.count = 0
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def wait(self, count=1):
+        return self.bucket.reserve(count) + self.delay
+
+    def observe(self, seconds, count=1, size=0):
+        latency = seconds / (size + max(1, count) * PACE_OVERHEAD)
+        with self.lock:
+            self.count += count
+            if self.baseline is None:
+                self.baseline = latency
+            elif latency > self.baseline * LATENCY_FACTOR:
+                self._backoff()
+            else:
+                self.delay = self.delay / 2 if self.delay > PACE_MIN else 0.0
+            #slow moving so a backlog of slow pages still counts as rising
+            self.baseline += (latency - self.baseline) * 0.05
+
+    def throttled(self):
+        with self.lock:
+            self._backoff()
+
+    def rate(self):
+        return self.count / max(time.time() - self.started, 0.001)
+
+    def _backoff(self):
+        self.delay = min(PACE_MAX, max(PACE_MIN, self.delay * 2))
+
+
+class Batch():
+    #writes of one page, the meta may only move once all are durable
+    def __init__(self, fsync='none'):
+        self.fsync = fsync
+        self.cond = threading.Condition()
+        self.pending = 0
+        self.paths = []
+        self.error = None
+
+    def add(self):
+        with self.cond:
+            self.pending += 1
+
+    def wrote(self, path):
+        with self.cond:
+            self.paths.append(path)
+
+    def done(self, path, error=None):
+        with self.cond:
+            self.pending -= 1
+            if path is not None:
+                self.paths.append(path)
+            if error is not None and self.error is None:
+                self.error = error
+            self.cond.notify_all()
+
+    def wait(self):
+        with self.cond:
+            while self.pending > 0:
+                self.cond.wait()
+        if self.error is not None:
+            raise self.error
+        if self.fsync == 'batch':
+            for path in set(self.paths):
+                #windows only flushes a handle open for writing
+                fd = os.open(path, os.O_RDWR)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+        if self.fsync != 'none' and os.name != 'nt':
+            #the renames are only durable once the directory is
+            for path in set(os.path.dirname(x) for x in self.paths):
+                fd = os.open(path, os.O_RDONLY)
+                try:
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+
+
+class _Copy():
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+class Codec():
+    #stored bodies as they are, subclass and add to CODECS for others
+    name = 'none'
+    suffix = ''
+
+    def __init__(self, level=-1):
+        self.level = level
+
+    def compressor(self):
+        return _Copy()
+
+    def decompress(self, data):
+        return data
+
+
+class ZlibCodec(Codec):
+    name = 'zlib'
+    suffix = '.z'
+
+    def compressor(self):
+        return zlib.compressobj(self.level)
+
+    def decompress(self, data):
+        return zlib.decompress(data)
+
+
+class GzipCodec(Codec):
+    name = 'gzip'
+    suffix = '.gz'
+
+    def compressor(self):
+        #wbits 31 writes the gzip header, files open with gzip/zcat
+        return zlib.compressobj(self.level, zlib.DEFLATED, 31)
+
+    def decompress(self, data):
+        return gzip.decompress(data)
+
+
+CODECS = {'none': Codec, 'zlib': ZlibCodec, 'gzip': GzipCodec}
+
+
+def read_message(path):
+    #raw body of a stored message whatever codec wrote it
+    with open(path, 'rb') as f:
+        data = f.read()
+    for codec in CODECS.values():
+        if codec.suffix and path.endswith(codec.suffix):
+            return codec().decompress(data)
+    return data
+
+
+class Writer():
+    #writer threads behind a bounded queue, 0 threads writes inline
+    #with a store every body is kept once under its sha256 and linked
+    #compression runs here too, zlib lets go of the GIL while it works
+    def __init__(self,
+                 threads=0,
+                 depth=0x40,
+                 fsync='none',
+                 store=None,
+                 segments=None,
+                 codec=None):
+        self.fsync = fsync
+        self.store = store
+        self.segments = segments
+        self.codec = Codec() if codec is None else codec
+        self.queue = queue.Queue(depth)
+        self.threads = []
+        for _ in range(threads):
+            t = threading.Thread(target=self._run)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def batch(self):
+        return Batch(self.fsync)
+
+    def submit(self, batch, path, data, fallback):
+        batch.add()
+        if not self.threads:
+            self._write_one(batch, path, data, fallback)
+            return
+        #blocks when the disk lags, bodies in flight stay bounded
+        self.queue.put((self._write_one, (batch, path, data, fallback)))
+
+    def append(self, batch, folder, uid, _date, data):
+        batch.add()
+        if not self.threads:
+            self._append_one(batch, folder, uid, _date, data)
+            return
+        self.queue.put((self._append_one, (batch, folder, uid, _date, data)))
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        if self.segments is not None:
+            self.segments.close()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            func, args = item
+            func(*args)
+
+    def _write_one(self, batch, path, data, fallback):
+        path += self.codec.suffix
+        fallback += self.codec.suffix
+        try:
+            try:
+                if self.store is None:
+                    path = self._write(path, data)
+                else:
+                    path = self._link(batch, path, data)
+            except IOError as e:
+                #full path
+                logger.error('write file failed ,path is %s ,error:%s', path,
+                             e)
+                #directory may be gone since it was cached, create it again
+                _DIRS.discard(os.path.dirname(path))
+                os.makedirs(os.path.dirname(fallback), exist_ok=True)
+                #save again
+                path = self._write(fallback, data)
+            batch.done(path)
+        except Exception as e:
+            batch.done(None, e)
+        finally:
+            if isinstance(data, imaplib.Spool):
+                data.close()
+
+    def _append_one(self, batch, folder, uid, _date, data):
+        try:
+            paths = self.segments.append(folder, uid, _date, data,
+                                         self.fsync == 'file', self.codec)
+            batch.wrote(paths[1])
+            batch.done(paths[0])
+        except Exception as e:
+            logger.error('append to segment failed ,folder is %s ,error:%s',
+                         folder, e)
+            batch.done(None, e)
+        finally:
+            if isinstance(data, imaplib.Spool):
+                data.close()
+
+    def _link(self, batch, path, data):
+        digest = self._digest(data)
+        obj = os.path.join(self.store, digest[:2],
+                           digest[2:] + '.eml' + self.codec.suffix)
+        if not os.path.exists(obj):
+            d = os.path.dirname(obj)
+            if d not in _DIRS:
+                os.makedirs(d, exist_ok=True)
+                _DIRS.add(d)
+            self._write(obj, data)
+            batch.wrote(obj)
+        tmp = '{0}.{1}.{2}.part'.format(path, os.getpid(),
+                                        threading.get_ident())
+        try:
+            os.link(obj, tmp)
+        except OSError as e:
+            #no hardlinks here (other device, fat), keep a full copy
+            logger.debug('link %s failed, copy instead:%s', obj, e)
+            return self._write(path, data)
+        os.replace(tmp, path)
+        return path
+
+    def _digest(self, data):
+        h = hashlib.sha256()
+        if isinstance(data, imaplib.Spool):
+            data.seek(0)
+            for chunk in iter(
+                    functools.partial(data.read, imaplib._SPOOL_CHUNK), b''):
+                h.update(chunk)
+        else:
+            h.update(data)
+        return h.hexdigest()
+
+    def _write(self, path, data):
+        #readers never see a half written file, only the rename
+        #two threads may write the same object, each uses its own part
+        tmp = '{0}.{1}.{2}.part'.format(path, os.getpid(),
+                                        threading.get_ident())
+        c = self.codec.compressor()
+        with open(tmp, 'wb') as f:
+            if isinstance(data, imaplib.Spool):
+                #write chunk by chunk, body is never fully in memory
+                data.seek(0)
+                for chunk in iter(
+                        functools.partial(data.read, imaplib._SPOOL_CHUNK),
+                        b''):
+                    f.write(c.compress(chunk))
+            else:
+                f.write(c.compress(data))
+            f.write(c.flush())
+            f.flush()
+            if self.fsync == 'file':
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+        return path
+
+
+class Segments():
+    #append only segment files per folder instead of one file per message
+    #record is 'MSG uid length' line, the body and a newline, folder.idx
+    #holds 'uid segment offset length date codec' lines written after it
+    def __init__(self, root, size=SEGMENT_SIZE):
+        self.root = root
+        self.size = size
+        self.lock = threading.Lock()
+        self.folders = {}
+
+    def append(self, folder, uid, _date, data, fsync=False, codec=None):
+        with self.lock:
+            seg = self.folders.get(folder)
+            if seg is None:
+                seg = _Segment(os.path.join(self.root, folder), self.size)
+                self.folders[folder] = seg
+        return seg.append(uid, _date, data, fsync, codec)
+
+    def close(self):
+        with self.lock:
+            for seg in self.folders.values():
+                seg.close()
+            self.folders = {}
+
+
+class _Segment():
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        numbers = [
+            int(f[4:-4]) for f in os.listdir(path)
+            if f.startswith('seg-') and f.endswith('.dat')
+        ]
+        self.number = max(numbers) if numbers else 0
+        self.index = open(os.path.join(path, 'folder.idx'), 'a')
+        self._open()
+
+    def _open(self):
+        self.name = 'seg-{0:05d}.dat'.format(self.number)
+        #not append mode, compressed records patch their header
+        path = os.path.join(self.path, self.name)
+        self.file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        self.offset = self.file.seek(0, os.SEEK_END)
+
+    def append(self, uid, _date, data, fsync=False, codec=None):
+        codec = codec or Codec()
+        with self.lock:
+            if self.offset >= self.size:
+                self.file.close()
+                self.number += 1
+                self._open()
+            if codec.name == 'none':
+                length = len(data)
+                head = 'MSG {0} {1}\n'.format(uid, length).encode()
+                self.file.write(head)
+                if isinstance(data, imaplib.Spool):
+                    data.seek(0)
+                    shutil.copyfileobj(data, self.file, imaplib._SPOOL_CHUNK)
+                else:
+                    self.file.write(data)
+            else:
+                #compressed chunk by chunk, the size is only known at the
+                #end so the header is written with room and patched
+                head = 'MSG {0} {1:016d}\n'.format(uid, 0).encode()
+                self.file.write(head)
+                c = codec.compressor()
+                length = 0
+                for chunk in _chunks(data):
+                    out = c.compress(chunk)
+                    self.file.write(out)
+                    length += len(out)
+                out = c.flush()
+                self.file.write(out)
+                length += len(out)
+                self.file.seek(self.offset)
+                self.file.write('MSG {0} {1:016d}\n'.format(uid,
+                                                            length).encode())
+                self.file.seek(0, os.SEEK_END)
+            self.file.write(b'\n')
+            self.file.flush()
+            if fsync:
+                os.fsync(self.file.fileno())
+            #index only points at records that are complete
+            self.index.write('{0} {1} {2} {3} {4} {5}\n'.format(
+                uid, self.name, self.offset + len(head), length,
+                _date.strftime('%Y-%m-%d'), codec.name))
+            self.index.flush()
+            if fsync:
+                os.fsync(self.index.fileno())
+            self.offset = self.file.tell()
+            return (os.path.join(self.path, self.name), self.index.name)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+            self.index.close()
+
+
+class SegmentReader():
+    #read messages back from segments by user, mailbox and uid
+    #user is the directory name, with the group when grouped
+    def __init__(self, root):
+        self.root = os.path.join(root, 'segments')
+        self.indexes = {}
+
+    def index(self, user, mailbox):
+        folder = os.path.normpath(os.path.join(self.root, user, mailbox))
+        idx = self.indexes.get(folder)
+        if idx is None:
+            idx = {}
+            path = os.path.join(folder, 'folder.idx')
+            if os.path.exists(path):
+                with open(path) as f:
+                    for line in f:
+                        arr = line.split()
+                        if len(arr) == 5:
+                            arr.append('none')
+                        if len(arr) != 6:
+                            continue
+                        #the latest copy of a uid wins
+                        idx[int(arr[0])] = (os.path.join(folder, arr[1]),
+                                            int(arr[2]), int(arr[3]), arr[4],
+                                            arr[5])
+            self.indexes[folder] = idx
+        return idx
+
+    def uids(self, user, mailbox):
+        return sorted(self.index(user, mailbox))
+
+    def date(self, user, mailbox, uid):
+        return self.index(user, mailbox)[uid][3]
+
+    def get(self, user, mailbox, uid):
+        path, offset, length, _, codec = self.index(user, mailbox)[uid]
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            return CODECS[codec]().decompress(f.read(length))
+
+
+def convert(root, size=SEGMENT_SIZE):
+    #pack an existing email/ tree into segments/, the tree is kept
+    src = os.path.join(root, 'email')
+    segments = Segments(os.path.join(root, 'segments'), size)
+    count = 0
+    try:
+        for path, dirs, files in os.walk(src):
+            dirs.sort()
+            emls = []
+            for f in files:
+                if not any(f.endswith('.eml' + c.suffix)
+                           for c in CODECS.values()):
+                    continue
+                try:
+                    emls.append((int(f.split('-', 1)[0]), f))
+                except ValueError:
+                    logger.warning('skip %s, no uid in name', f)
+            if not emls:
+                continue
+            #email/<user>/<mailbox>/<date>/<uid>-<subject>.eml
+            folder = os.path.relpath(os.path.dirname(path), src)
+            _date = datetime.datetime.strptime(os.path.basename(path),
+                                               '%Y-%m-%d')
+            for uid, f in sorted(emls):
+                segments.append(folder, uid, _date,
+                                read_message(os.path.join(path, f)))
+                count += 1
+    finally:
+        segments.close()
+    logger.info('converted %d messages into %s', count,
+                os.path.join(root, 'segments'))
+    return count
+
+
+def _chunks(body):
+    #body piece by piece, at most one chunk is copied at a time
+    if isinstance(body, imaplib.Spool):
+        body.seek(0)
+        for chunk in iter(
+                functools.partial(body.read, imaplib._SPOOL_CHUNK), b''):
+            yield chunk
+        body.seek(0)
+        return
+    view = memoryview(body)
+    for i in range(0, len(view), imaplib._SPOOL_CHUNK):
+        yield bytes(view[i:i + imaplib._SPOOL_CHUNK])
+
+
+def _blank(body):
+    #whitespace only body, stops at the first chunk with any text
+    for chunk in _chunks(body):
+        if chunk.strip():
+            if isinstance(body, imaplib.Spool):
+                body.seek(0)
+            return False
+    return True
+
+
+def _header_end(data):
+    #offset just past the blank line closing the headers, -1 if none yet
+    crlf = data.find(b'\r\n\r\n')
+    #bare lf only counts before the first crlf blank line
+    lf = data.find(b'\n\n', 0, len(data) if crlf < 0 else crlf)
+    if lf >= 0:
+        return lf + 2
+    return crlf + 4 if crlf >= 0 else -1
+
+
+def _uid_ranges(uids):
+    #sorted uids to [(lo, hi), ...] of consecutive runs
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        elif not ranges or uid > ranges[-1][1]:
+            ranges.append([uid, uid])
+    return [(lo, hi) for lo, hi in ranges]
+
+
+def _uid_set(uids):
+    #uids in any order to an imap set like 1000:1099,1203
+    return ','.join(
+        str(lo) if lo == hi else '{0}:{1}'.format(lo, hi)
+        for lo, hi in _uid_ranges(sorted(uids)))
+
+
+def _esearch_all(data):
+    #'(TAG "A1") UID ALL 1:3,7' replies to a sorted array of uids
+    ranges = []
+    for line in data:
+        if not line:
+            continue
+        toks = line.split()
+        for k in range(len(toks) - 1):
+            if toks[k].upper() != b'ALL':
+                continue
+            for part in toks[k + 1].split(b','):
+                a, _, b = part.partition(b':')
+                a = int(a)
+                b = int(b) if b else a
+                ranges.append((min(a, b), max(a, b)))
+    uids = array('I')
+    for lo, hi in sorted(ranges):
+        if uids and lo <= uids[-1]:
+            lo = uids[-1] + 1
+        uids.extend(range(lo, hi + 1))
+    return uids
+
+
+class Watermark():
+    #downloaded uids of one mailbox as sorted disjoint ranges
+    def __init__(self, uidvalidity=0):
+        self.uidvalidity = uidvalidity
+        #HIGHESTMODSEQ seen at the last complete sync, 0 is unknown
+        self.modseq = 0
+        self.los = array('I')
+        self.his = array('I')
+        #body rules of the last complete two phase run, '' is unknown
+        self.rules = ''
+        #lines not yet appended to the meta file
+        self.journal = ['V {0}'.format(uidvalidity)] if uidvalidity else []
+        self.lines = 0
+
+    def __contains__(self, uid):
+        i = bisect.bisect_right(self.los, uid) - 1
+        return i >= 0 and uid <= self.his[i]
+
+    @property
+    def highest(self):
+        return self.his[-1] if self.his else 0
+
+    def validate(self, uidvalidity):
+        #a new uidvalidity makes every stored uid meaningless
+        if uidvalidity == self.uidvalidity:
+            return True
+        changed = self.uidvalidity != 0
+        if changed:
+            self.los, self.his = array('I'), array('I')
+            self.modseq = 0
+            self.rules = ''
+        self.uidvalidity = uidvalidity
+        self.journal.append('V {0}'.format(uidvalidity))
+        return not changed
+
+    def synced(self, modseq):
+        if modseq and modseq != self.modseq:
+            self.modseq = modseq
+            self.journal.append('M {0}'.format(modseq))
+
+    def judged(self, rules):
+        if rules != self.rules:
+            self.rules = rules
+            self.journal.append('P {0}'.format(rules))
+
+    def add(self, lo, hi):
+        self._merge(lo, hi)
+        self.journal.append('R {0} {1}'.format(lo, hi))
+
+    def update(self, uids):
+        for lo, hi in _uid_ranges(sorted(uids)):
+            self.add(lo, hi)
+
+    def missing(self):
+        #uids not covered yet as an imap uid set, open ended at the top
+        parts = []
+        lo = 1
+        for a, b in zip(self.los, self.his):
+            if a - 1 > lo:
+                parts.append('{0}:{1}'.format(lo, a - 1))
+            elif a - 1 == lo:
+                parts.append(str(lo))
+            lo = b + 1
+        parts.append('{0}:*'.format(lo))
+        return ','.join(parts)
+
+    def missing_count(self, top):
+        #most uids missing() can match when top is the highest uid
+        count, lo = 0, 1
+        for a, b in zip(self.los, self.his):
+            count += max(0, a - lo)
+            lo = b + 1
+        return count + max(1, top - lo + 1)
+
+    def fill(self, existing):
+        #gaps without an existing uid can never be downloaded, close them,
+        #existing is sorted
+        gaps = []
+        if self.los and self.los[0] > 1 and \
+                (not existing or existing[0] >= self.los[0]):
+            gaps.append((1, self.los[0] - 1))
+        for k in range(len(self.los) - 1):
+            lo, hi = self.his[k] + 1, self.los[k + 1] - 1
+            i = bisect.bisect_left(existing, lo)
+            if i >= len(existing) or existing[i] > hi:
+                gaps.append((lo, hi))
+        for lo, hi in gaps:
+            self.add(lo, hi)
+
+    def replay(self, line):
+        arr = line.split()
+        if len(arr) == 2 and arr[0] == 'V':
+            self.validate(int(arr[1]))
+        elif len(arr) == 2 and arr[0] == 'M':
+            self.modseq = int(arr[1])
+        elif len(arr) <= 2 and arr and arr[0] == 'P':
+            self.rules = arr[1] if len(arr) == 2 else ''
+        elif len(arr) == 3 and arr[0] == 'R' and int(arr[1]) <= int(arr[2]):
+            self._merge(int(arr[1]), int(arr[2]))
+        #torn tail of a crashed append is skipped
+
+    def dump(self):
+        lines = ['V {0}'.format(self.uidvalidity)] if self.uidvalidity else []
+        lines.extend('R {0} {1}'.format(lo, hi)
+                     for lo, hi in zip(self.los, self.his))
+        if self.modseq:
+            lines.append('M {0}'.format(self.modseq))
+        if self.rules:
+            lines.append('P {0}'.format(self.rules))
+        return lines
+
+    def _merge(self, lo, hi):
+        i = bisect.bisect_left(self.his, lo - 1)
+        j = bisect.bisect_right(self.los, hi + 1)
+        if i < j:
+            lo = min(lo, self.los[i])
+            hi = max(hi, self.his[j - 1])
+        self.los[i:j] = array('I', [lo])
+        self.his[i:j] = array('I', [hi])
+
+
 class Mailer():
     def __init__(self,
                  root=None,
                  imap=None,
                  ssl=False,
                  groups=None,
+                 poolsize=0x0a,
+                 hostlimit=0,
+                 loginrate=0,
+                 spoolsize=0,
+                 incremental=True,
+                 maxrate=0,
+                 prefetch=1,
+                 twophase=False,
+                 summaryonly=False,
+                 maxbody=0,
+                 bodyfolders=None,
+                 bodysince=None,
+                 writers=2,
+                 fsync='none',
+                 dedup=False,
+                 output='files',
+                 segmentsize=SEGMENT_SIZE,
+                 codec='none',
+                 codeclevel=-1,
+                 hostrates=None,
+                 summarybatch=0x64,
+                 summaryinterval=60,
                  pagesize=0x64,
                  timeout=None,
+                 keepalive=300,
+                 idlefolders=None,
+                 idlepoll=60,
+                 order='largest',
+                 usersessions=1,
+                 shard=None,
+                 trace='ring',
+                 tracefile=None,
                  **users):
         self.root = root
         self.imap = imap
@@ -51,40 +939,133 @@ class Mailer():
         self.host = None
         self.port = 143
         self.cache = None
+        self.envelopes = {}
         self.groups = groups
         self.pagesize = pagesize
         self.timeout = timeout
         #the max size is 10
         #start event loop
         self.loop = asyncio.get_event_loop()
+        #imap calls are blocking, run them on executor so sessions overlap
+        self.executor = ThreadPoolExecutor(poolsize)
+        #max sessions per imap host at once, 0 means poolsize
+        self.hostlimit = poolsize if hostlimit <= 0 else hostlimit
+        self.semaphores = {}
+        #logins per second per imap host, 0 means no limit
+        self.loginrate = loginrate
+        self.buckets = {}
+        self.failed_lock = threading.Lock()
+        #users the server refused, watchers give them up
+        self.denied = set()
+        #sessions reused per user, NOOP on idle ones every keepalive secs
+        self.keepalive = keepalive
+        self.sessions = SessionPool()
+        #watch mode waits in IDLE on INBOX plus these folders, polls
+        #without IDLE
+        self.idlefolders = ['INBOX'] + [
+            f for f in idlefolders or [] if f.upper() != 'INBOX'
+        ]
+        self.idlepoll = idlepoll
+        self.idlers = None
+        self.stopped = threading.Event()
+        #folder work order is largest, inbox or none (listing order)
+        self.order = order
+        #sessions one account may use at once on different folders
+        self.usersessions = max(1, usersessions)
+        self.accounts = {}
+        #HIGHESTMODSEQ seen by the planning STATUS of folders that moved
+        self.planned = {}
+        #worker number under supervise, shards keep their own failed file
+        self.shard = shard
+        #imap line trace is off, ring (last lines, shown on abort) or file
+        self.trace = trace
+        self.tracefile = tracefile
+        #bodies bigger than this are spooled to disk by imaplib, 0 is off
+        self.spoolsize = spoolsize
+        #search only uids above the watermark and its holes
+        self.incremental = incremental
+        #messages per second ceiling, hostrates overrides it per host
+        self.maxrate = maxrate
+        self.hostrates = {} if hostrates is None else hostrates
+        self.pacers = {}
+        #pages fetched ahead while the current one is written, 0 is off
+        self.prefetch = prefetch
+        #envelopes first for the summary, then bodies matching the rules
+        self.twophase = twophase or summaryonly
+        self.summaryonly = summaryonly
+        self.maxbody = maxbody
+        self.bodyfolders = bodyfolders
+        self.bodysince = bodysince
+        #writer threads during download, fsync is none, batch or file
+        self.writers = writers
+        self.fsync = fsync
+        #store bodies once under root/objects, folders hold hardlinks
+        self.store = os.path.join(root, 'objects') if dedup else None
+        #files writes one .eml per message, segments packs them per folder
+        self.segments = None
+        if output == 'segments':
+            self.segments = Segments(os.path.join(root, 'segments'),
+                                     segmentsize)
+        #none, zlib or gzip, level -1 is the zlib default
+        self.codec = CODECS[codec](codeclevel)
+        self.writer = Writer(fsync=fsync,
+                             store=self.store,
+                             segments=self.segments,
+                             codec=self.codec)
         #don,t use lock
         self.summary = {}
+        #counts not yet appended to the summary log, flushed in batches
+        self.deltas = {}
+        self.summary_pending = {}
+        self.summary_stamp = {}
+        #folders of one account update the same records on several threads
+        self.summary_lock = threading.RLock()
+        self.summarybatch = summarybatch
+        self.summaryinterval = summaryinterval
 
-    def _list_all_clients(self):
+    def _parse_imap(self):
         hosts = self.imap.split(':')
         self.host = hosts[0]
         if len(hosts) >= 2:
             self.port = hosts[1]
-        cache = {}
+        self.buckets[self.host] = TokenBucket(
+            self.loginrate, burst=int(self.loginrate))
+        self.pacers[self.host] = Pacer(
+            self.hostrates.get(self.host, self.maxrate), burst=self.pagesize)
         if '163' in self.host:
-            imaplib._MAXLINE = 100000000
             imaplib._FORCE_HEADER = True
-        for u, p in list(self.users.items()):
-            try:
-                conn = IMAPClient(
-                    self.host,
-                    port=self.port,
-                    ssl=self.ssl,
-                    use_uid=True,
-                    timeout=self.timeout)
-                conn.login(u, p)
-                cache[u] = conn
-            except Exception as e:
-                logger.error('create imap client failed %s', e)
-                if 'LOGIN' in str(e):
-                    self._save_login_failed(u, p)
-        #return all clients
-        return cache
+        if self.spoolsize > 0:
+            imaplib._SPOOL_SIZE = self.spoolsize
+        if self.trace == 'off':
+            imaplib.Trace = None
+        elif self.trace == 'file':
+            path = self.tracefile
+            if not path:
+                name = 'imaptrace.log' if self.shard is None else \
+                    'imaptrace-{0}.log'.format(self.shard)
+                path = os.path.join(self.root, name)
+            imaplib.Trace = imaplib.FileTrace(path)
+
+    async def _login(self, u, p):
+        #pace the handshakes, each waiter books its own slot
+        await asyncio.sleep(self.buckets[self.host].reserve())
+        try:
+            conn = await self._run(
+                IMAPClient,
+                self.host,
+                port=self.port,
+                ssl=self.ssl,
+                use_uid=True,
+                timeout=self.timeout)
+            _quiet(conn)
+            await self._run(conn.login, u, p)
+            return conn
+        except Exception as e:
+            logger.error('create imap client failed %s', e)
+            if 'LOGIN' in str(e):
+                self.denied.add(u)
+                await self._run(self._save_login_failed, u, p)
+        return None
 
     def _list_mailbox(self, conn):
         mailboxes = []
@@ -94,84 +1075,385 @@ class Mailer():
         return mailboxes
 
     def _download(self, user, name, conn):
-        conn.select_folder(name)
-        messages = conn.search()
         #split for many segment
         _key = '{0}-{1}'.format(user, name)
-        _history = self.cache.get(_key, None)
-        _download_list = messages
+        marks = self._marks(name)
+        _history = marks.get(_key, None)
+        modseq = 0
+        if _key in self.planned:
+            #the planning STATUS already saw this folder move
+            modseq = self.planned.pop(_key)
+        elif _condstore(conn):
+            #one STATUS tells whether anything moved since the last run
+            status = conn.folder_status(name,
+                                        ['UIDVALIDITY', 'HIGHESTMODSEQ'])
+            modseq = status.get(b'HIGHESTMODSEQ', 0)
+            if self._unchanged(user, name, status):
+                return
+        info = conn.select_folder(name)
         index = 0
+        uidvalidity = info.get(b'UIDVALIDITY', 0)
+        if _history is not None and not _history.validate(uidvalidity):
+            logger.warn('Email(%s[%s]) UIDVALIDITY CHANGED, RESYNC', user,
+                        name)
+            _history = None
         if _history is None:
-            #download list
-            self.cache[_key] = set()
-            _download_list = list(_download_list)
-            _download_list.reverse()
-        #index +1 is len
+            marks[_key] = Watermark(uidvalidity)
+        #uids a two phase run counted, also when this run is a single phase
+        envelopes = self.envelopes.get(_key, None)
+        if envelopes is not None:
+            #emptied on a new UIDVALIDITY like the history above
+            envelopes.validate(uidvalidity)
+        elif self.twophase:
+            envelopes = self.envelopes[_key] = Watermark(uidvalidity)
+        rules = self._rules(name)
+        judged = self.twophase and envelopes.rules == rules
+        if _history is None or not self.incremental or \
+                len(_history.los) > MAX_SEARCH_GAPS:
+            messages = self._search(conn, name, info, [b'ALL'])
         else:
-            _download_list = list(set(messages).difference(set(_history)))
-            _download_list.reverse()
+            #n:* answers the top uid even below n, filtered out below
+            uidnext = info.get(b'UIDNEXT', 0)
+            messages = self._search(
+                conn, name, info,
+                [b'UID', _history.missing().encode('ascii')],
+                _history.missing_count(uidnext - 1) if uidnext else None)
+        _download_list = messages
+        if _history is not None:
+            _download_list = [x for x in messages if x not in _history]
+        skipped = 0
+        if judged:
+            #these rules left the bodies out before, size and date of a
+            #message never change
+            skipped = len(_download_list)
+            _download_list = [x for x in _download_list if x not in envelopes]
+            skipped -= len(_download_list)
+        #newest first, every page a contiguous slice so it fetches as a
+        #few uid ranges
+        _download_list = sorted(_download_list, reverse=True)
         if len(_download_list) <= 0:
             #nothing to do
             logger.warn('Email(%s[%s]) NO NEW MESSAGE TO BE RECEIVED!!', user,
                         name)
+            marks[_key].fill(messages)
+            if not skipped:
+                marks[_key].synced(modseq)
+            if self.twophase:
+                envelopes.synced(modseq)
+                if marks is self.cache:
+                    #any body still left out was judged by these rules
+                    envelopes.judged(rules)
+            self._flush_meta(key=_key)
             return
+        if self.twophase and not judged:
+            #uids counted from here on are judged by new rules, known only
+            #once the run completes
+            envelopes.judged('')
+        started = time.time()
         print(('\n' + self._get_dir(user) + '/' + name + ':'))
         sys.stdout.write("\r%d/%d" % (index, len(_download_list)))
         sys.stdout.flush()
-        if len(_download_list) > self.pagesize:
-            while len(_download_list) > index:
-                end = index + self.pagesize
-                old = index
-                if len(_download_list) < end:
-                    end = len(_download_list)
-                #unmark read message
-                logger.info('begin to download %s .....',
-                            _download_list[index:end])
-                response = conn.fetch(_download_list[index:end],
-                                      ['BODY.PEEK[]'])
-                index = end
-                for msg_id, data in list(response.items()):
-                    old = old + 1
-                    sys.stdout.write("\r%d/%d" % (old, len(_download_list)))
-                    sys.stdout.flush()
-                    self._handle(user, name, msg_id, data)
-                    time.sleep(0.1)
-                self.cache[_key].update(_download_list[0:end])
-                self._flush_meta(key=_key)
+        pages = [
+            _download_list[i:i + self.pagesize]
+            for i in range(0, len(_download_list), self.pagesize)
+        ]
+        if self.twophase:
+            #bodies an earlier run left out, their envelopes are counted
+            known = set(x for x in _download_list if x in envelopes)
+            fetch = functools.partial(self._fetch_twophase,
+                                      conn,
+                                      name,
+                                      known=known)
         else:
-            logger.info('begin to download %s .....', _download_list)
-            response = conn.fetch(_download_list, ['BODY.PEEK[]'])
+            fetch = functools.partial(self._fetch, conn, parts=['BODY.PEEK[]'])
+        for page, response in self._prefetch(pages, fetch):
+            batch = self.writer.batch()
             for msg_id, data in list(response.items()):
                 index = index + 1
                 sys.stdout.write("\r%d/%d" % (index, len(_download_list)))
                 sys.stdout.flush()
-                self._handle(user, name, msg_id, data)
-                time.sleep(0.1)
-            self.cache[_key].update(_download_list)
+                #an envelope is counted once, a later run only saves the
+                #body it left behind
+                count = envelopes is None or msg_id not in envelopes
+                if self.twophase:
+                    self._handle_envelope(user, name, msg_id, data, batch,
+                                          count)
+                else:
+                    self._handle(user, name, msg_id, data, batch, count)
+            #page is on disk, now the meta may move
+            batch.wait()
+            if envelopes is not None:
+                envelopes.update(page)
+            if self.twophase and marks is self.cache:
+                #a body the rules left out stays missing, the next run
+                #fetches it again when the rules let it through
+                done = [
+                    x for x in page
+                    if x not in response or b'BODY[]' in response[x]
+                ]
+                skipped += len(page) - len(done)
+                page = done
+            #counts of the page go out before its uids, a crash in between
+            #must not drop them for good
+            self._flush_summary('{0}/发件人'.format(user),
+                                '{0}/收件人'.format(user))
+            if marks is self.cache:
+                self.cache[_key].update(page)
             self._flush_meta(key=_key)
+        #merge ranges split only by expunged uids
+        marks[_key].fill(messages)
+        if not skipped:
+            #modseq read before the download, later changes show up next
+            #run, a folder with bodies left out is never taken as unchanged
+            marks[_key].synced(modseq)
+        if self.twophase:
+            #every body left out was judged by these rules, the envelopes
+            #tell whether the folder moved since
+            envelopes.synced(modseq)
+            envelopes.judged(rules)
+        self._flush_meta(key=_key)
+        cost = max(time.time() - started, 0.001)
+        logger.info('Email(%s[%s]) %d messages in %.1fs, %.1f msg/s', user,
+                    name, len(_download_list), cost,
+                    len(_download_list) / cost)
         sys.stdout.write("\n")
         sys.stdout.flush()
         #conn.unselect_folder()
 
-    def _handle(self, user, name, msg_id, data):
+    def _search(self, conn, name, info, criteria, expect=None):
+        #uids matching criteria as a sorted array; a plain reply for a
+        #big folder is one line of many MB, so ESEARCH sends it as ranges
+        #and other servers are asked SEARCH_CHUNK messages at a time
+        #unless at most expect uids can match
+        if conn.has_capability('ESEARCH'):
+            data = conn._raw_command_untagged(b'SEARCH',
+                                              [b'RETURN', b'(ALL)'] +
+                                              criteria,
+                                              response_name='ESEARCH')
+            return _esearch_all(data)
+        untagged = conn._imap.untagged_responses
+        for _ in range(RELOGIN):
+            untagged.pop('EXPUNGE', None)
+            uids = array('I')
+            exists = info.get(b'EXISTS', 0)
+            if expect is not None and expect <= SEARCH_CHUNK:
+                chunks = [[]]
+            else:
+                #the last chunk is open ended for messages arrived since
+                chunks = [[('{0}:{1}'.format(lo, lo + SEARCH_CHUNK - 1)
+                            if lo + SEARCH_CHUNK <= exists else
+                            '{0}:*'.format(lo)).encode('ascii')]
+                          for lo in range(1, exists + 1, SEARCH_CHUNK)]
+            for chunk in chunks:
+                data = conn._raw_command_untagged(b'SEARCH', chunk + criteria)
+                found = sorted(
+                    int(x) for line in data if line for x in line.split())
+                #uids grow with sequence numbers, * may repeat the last one
+                if uids:
+                    found = found[bisect.bisect_right(found, uids[-1]):]
+                uids.extend(found)
+            #expunges shift sequence numbers, a chunk may have skipped one
+            if not untagged.pop('EXPUNGE', None) or len(chunks) <= 1:
+                return uids
+            logger.info('Email(%s) EXPUNGED DURING SEARCH, AGAIN', name)
+            info = conn.select_folder(name)
+        return uids
+
+    def _prefetch(self, pages, fetch):
+        if self.prefetch <= 0 or len(pages) <= 1:
+            for page in pages:
+                #unmark read message
+                logger.info('begin to download %s .....', page)
+                yield page, fetch(page)
+            return
+        #only the producer talks to the server until it has stopped
+        q = queue.Queue(self.prefetch)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                for page in pages:
+                    if stop.is_set():
+                        return
+                    logger.info('begin to download %s .....', page)
+                    q.put((page, fetch(page), None))
+                q.put((None, None, None))
+            except Exception as e:
+                q.put((None, None, e))
+
+        t = threading.Thread(target=produce)
+        t.daemon = True
+        t.start()
+        try:
+            while True:
+                page, response, error = q.get()
+                if error is not None:
+                    raise error
+                if page is None:
+                    return
+                yield page, response
+        finally:
+            stop.set()
+            #drain so a blocked put returns and the producer sees stop
+            while t.is_alive():
+                try:
+                    q.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+
+    def _fetch(self, conn, uids, parts):
+        pacer = self.pacers[self.host]
+        retry = 0
+        while True:
+            time.sleep(pacer.wait(len(uids)))
+            start = time.time()
+            try:
+                response = conn.fetch(_uid_set(uids), parts)
+            except imaplib.IMAP4.abort:
+                #BYE or dead socket, the session is gone anyway
+                pacer.throttled()
+                raise
+            except imaplib.IMAP4.error as e:
+                text = str(e).upper()
+                if retry >= PACE_RETRY or \
+                        not any(t in text for t in THROTTLE_TEXT):
+                    raise
+                retry += 1
+                pacer.throttled()
+                logger.warn('server throttling, slow down to %.2fs: %s',
+                            pacer.delay, e)
+                continue
+            size = sum(
+                len(data.get(b'BODY[]') or b'')
+                for data in list(response.values()))
+            pacer.observe(time.time() - start, len(uids), size)
+            return response
+
+    def _fetch_twophase(self, conn, name, uids, known=()):
+        #envelopes in known are counted already, only size and date are
+        #fetched to judge their bodies again, INTERNALDATE stands in for
+        #the envelope date
+        response = {}
+        fresh = [x for x in uids if x not in known]
+        if fresh:
+            response.update(
+                self._fetch(conn, fresh,
+                            ['ENVELOPE', 'RFC822.SIZE', 'INTERNALDATE']))
+        again = [x for x in uids if x in known]
+        if again:
+            response.update(
+                self._fetch(conn, again, ['RFC822.SIZE', 'INTERNALDATE']))
+        wanted = [
+            uid for uid, data in list(response.items())
+            if self._want_body(name, self._envelope_date(data),
+                               data.get(b'RFC822.SIZE', 0))
+        ]
+        if wanted:
+            parts = ['BODY.PEEK[]']
+            if any(x in known for x in wanted):
+                #the subject names the saved file
+                parts.append('ENVELOPE')
+            for uid, data in list(self._fetch(conn, wanted, parts).items()):
+                response[uid][b'BODY[]'] = data.get(b'BODY[]')
+                if b'ENVELOPE' in data:
+                    response[uid].setdefault(b'ENVELOPE', data[b'ENVELOPE'])
+        return response
+
+    def _rules(self, name):
+        #what decided the bodies of a folder, the same rules decide alike
+        if not self._want_folder(name):
+            return '-'
+        return '{0}:{1}'.format(self.maxbody, self.bodysince or '')
+
+    def _marks(self, name):
+        #where a folder's progress is kept: the bodies, or only the
+        #envelopes when the rules leave out every body of the folder
+        if self.twophase and not self._want_folder(name):
+            return self.envelopes
+        return self.cache
+
+    def _want_folder(self, name):
+        if self.summaryonly:
+            return False
+        return not self.bodyfolders or name in self.bodyfolders
+
+    def _want_body(self, name, _date, size):
+        if not self._want_folder(name):
+            return False
+        if self.maxbody > 0 and size > self.maxbody:
+            return False
+        if self.bodysince is not None and _date.date() < self.bodysince:
+            return False
+        return True
+
+    def _envelope_date(self, data):
+        env = data.get(b'ENVELOPE')
+        if env is not None and env.date is not None:
+            return env.date
+        if data.get(b'INTERNALDATE') is not None:
+            return data[b'INTERNALDATE']
+        return datetime.datetime.now()
+
+    def _address(self, addr):
+        if addr.mailbox is None:
+            #group syntax marker, no address
+            return None
+        return '{0}@{1}'.format(
+            addr.mailbox.decode('utf-8', 'replace'),
+            (addr.host or b'').decode('utf-8', 'replace'))
+
+    def _handle_envelope(self, user, name, msg_id, data, batch=None,
+                         count=True):
+        body = data.get(b'BODY[]')
+        if body is None and not count:
+            #counted before and its body is still left out
+            return
+        env = data.get(b'ENVELOPE')
+        if env is None:
+            logger.info('envelope is empty, skip, id is %s,name is %s',
+                        msg_id, name)
+            return
+        if body is not None:
+            subject = (env.subject or b'').decode('utf-8', 'replace')
+            text, encoding = email.header.decode_header(subject)[0]
+            if encoding is None:
+                encoding = 'gb2312'
+            self._save(user, name, self._envelope_date(data), msg_id,
+                       self._try_decode(text, encoding), body, batch)
+        if not count:
+            #already in the summary of an earlier run
+            return
+        _from = [self._address(a) for a in env.from_ or ()]
+        _to = [
+            self._address(a)
+            for a in (env.to or ()) + (env.cc or ()) + (env.bcc or ())
+        ]
+        _s_key = '{0}/发件人'.format(user)
+        self._update_record(_s_key, *_from)
+        _r_key = '{0}/收件人'.format(user)
+        self._update_record(_r_key, *set(_to))
+        self._mark_summary(_r_key, _s_key)
+
+    def _handle(self, user, name, msg_id, data, batch=None, count=True):
         body = data.get(b'BODY[]', None)
-        if body is None or str(body).strip() == '':
+        if body is None or _blank(body):
             logger.info('body is empty, skip, id is %s,name is %s', msg_id,
                         name)
             return
-        #RFC822
-        msg = email.message_from_bytes(body)
+        #RFC822, only the envelope headers are needed
+        msg = email.parser.BytesHeaderParser().parsebytes(self._head(body))
         logger.info('msg is %s', msg)
         _from = [] if msg.get_all('from') is None else msg.get_all('from')
         _to = [] if msg.get_all('to') is None else msg.get_all('to')
         _bcc = [] if msg.get_all('bcc') is None else msg.get_all('bcc')
         _cc = [] if msg.get_all('cc') is None else msg.get_all('cc')
         _s_key = '{0}/发件人'.format(user)
-        self._update_record(_s_key, *_from)
         _to.extend(_cc)
         _to.extend(_bcc)
         _r_key = '{0}/收件人'.format(user)
-        self._update_record(_r_key, *set(_to))
+        if count:
+            self._update_record(_s_key, *_from)
+            self._update_record(_r_key, *set(_to))
         text, encoding = email.header.decode_header(msg['Subject'])[0]
         if encoding is None:
             encoding = 'gb2312'
@@ -183,8 +1465,24 @@ class Mailer():
             _date = datetime.datetime.fromtimestamp(
                 time.mktime(email.utils.parsedate(msg.get('date'))))
         self._save(user, name, _date, msg_id, self._try_decode(text, encoding),
-                   data[b'BODY[]'])
-        self._flush_summary(_r_key, _s_key)
+                   body, batch)
+        if count:
+            self._mark_summary(_r_key, _s_key)
+
+    def _head(self, body):
+        if isinstance(body, bytes):
+            end = _header_end(body)
+            return body if end < 0 else body[:end]
+        #spooled or viewed body, only copy the header block
+        head = b''
+        for chunk in _chunks(body):
+            head += chunk
+            if _header_end(head) >= 0:
+                break
+        if isinstance(body, imaplib.Spool):
+            body.seek(0)
+        end = _header_end(head)
+        return head if end < 0 else head[:end]
 
     def _try_decode(self, name, encoding):
         try:
@@ -194,83 +1492,366 @@ class Mailer():
             return 'InvalidEncodingFile'
 
     def download(self):
+        self._start()
+        self._sync()
+        self._stop()
+
+    def watch(self):
+        #daemon mode, one full pass then IDLE on every watched folder and
+        #download it again whenever the server reports new messages
+        self._start()
+        self._sync()
+        watched = [(u, p, name) for u, p in list(self.users.items())
+                   for name in self.idlefolders]
+        #IDLE blocks a thread per session, keep them off the fetch executor
+        self.idlers = ThreadPoolExecutor(max(1, len(watched)))
+        watchers = asyncio.gather(
+            *[self._idle(u, p, name) for u, p, name in watched])
+        try:
+            self.loop.run_until_complete(watchers)
+        except (KeyboardInterrupt, SystemExit):
+            logger.info('stop watching, wait for sessions to leave IDLE')
+            self.stopped.set()
+            self.loop.run_until_complete(watchers)
+        self.idlers.shutdown()
+        self._stop()
+
+    def _start(self):
         self.cache = self._load_meta()
-        clients = self._list_all_clients()
+        #two phase: uids whose envelope is counted, bodies may lag behind
+        self.envelopes = self._load_marks('.envs')
+        #counts of earlier runs, plus the log of one that did not finish
+        self._load_summary()
+        self._parse_imap()
+        self.writer = Writer(self.writers, self.pagesize, self.fsync,
+                             self.store, self.segments, self.codec)
+        self.sessions = SessionPool(self.keepalive, self.hostlimit)
+
+    def _sync(self):
+        #every (account, folder) is one work item, sized by STATUS
+        plans = self.loop.run_until_complete(
+            asyncio.gather(
+                *[self._plan(u, p) for u, p in list(self.users.items())]))
+        items = self._order([x for plan in plans for x in plan])
         handlers = []
-        for u, c in list(clients.items()):
-            #self._wrap_download(c,u)
-            handlers.append(self._wrap_download(c, u))
+        for u, name, _ in items:
+            handlers.append(self._work(u, self.users[u], name))
         #wait for ok
         self.loop.run_until_complete(asyncio.gather(*handlers))
+
+    def _stop(self):
         self.loop.close()
+        self.executor.shutdown()
+        self.writer.close()
+        self.sessions.close()
         self._flush_meta()
+        self._flush_summary(*list(self.deltas.keys()))
+        self._compact_summary()
+        for host, pacer in list(self.pacers.items()):
+            logger.info('host %s: %d messages, %.1f msg/s', host,
+                        pacer.count, pacer.rate())
+
+    def _host_semaphore(self, host):
+        #create lazily, semaphore must belong to the running loop
+        sem = self.semaphores.get(host)
+        if sem is None:
+            sem = asyncio.Semaphore(self.hostlimit)
+            self.semaphores[host] = sem
+        return sem
+
+    async def _run(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs))
+
+    async def _session(self, u, p):
+        conn = self.sessions.get(self.host, u)
+        if conn is not None:
+            return conn
+        return await self._login(u, p)
+
+    def _account_semaphore(self, user):
+        sem = self.accounts.get(user)
+        if sem is None:
+            sem = asyncio.Semaphore(self.usersessions)
+            self.accounts[user] = sem
+        return sem
 
-    async def _wrap_download(self, c, u):
+    async def _plan(self, u, p):
+        #list and size the folders of one account, the session is reused
+        async with self._host_semaphore(self.host):
+            c = await self._session(u, p)
+            if c is None:
+                return []
+            try:
+                boxes = await self._run(self._list_mailbox, c)
+                items = await self._run(self._estimate, u, c, boxes)
+            except Exception as e:
+                logger.error('handle error message %s', e)
+                await self._run(_logout, c)
+                return []
+            #may log out an older session, off the loop
+            await self._run(self.sessions.put, self.host, u, c)
+        return items
+
+    def _estimate(self, user, conn, boxes):
+        #cost is the messages above the watermark, all of them when new,
+        #with CONDSTORE the same STATUS drops folders that did not move
+        condstore = _condstore(conn)
+        names = ['MESSAGES', 'UIDNEXT']
+        if condstore:
+            names.extend(['UIDVALIDITY', 'HIGHESTMODSEQ'])
+        items = []
+        for name in boxes:
+            _key = '{0}-{1}'.format(user, name)
+            try:
+                status = conn.folder_status(name, names)
+            except imaplib.IMAP4.abort:
+                raise
+            except imaplib.IMAP4.error as e:
+                #\Noselect folders have no status, _download says why
+                logger.debug('status of %s[%s] failed %s', user, name, e)
+                items.append((user, name, 0))
+                continue
+            if condstore:
+                if self._unchanged(user, name, status):
+                    continue
+                self.planned[_key] = status.get(b'HIGHESTMODSEQ', 0)
+            cost = status.get(b'MESSAGES', 0)
+            _history = self._marks(name).get(_key)
+            if _history is not None and _history.highest:
+                cost = min(
+                    cost,
+                    max(0,
+                        status.get(b'UIDNEXT', 0) - 1 - _history.highest))
+            items.append((user, name, cost))
+        return items
+
+    def _unchanged(self, user, name, status):
+        #same HIGHESTMODSEQ and UIDVALIDITY as at the last complete sync,
+        #of the bodies or of the envelopes when the same rules left some out
+        _key = '{0}-{1}'.format(user, name)
+        marks = [self._marks(name).get(_key)]
+        envelopes = self.envelopes.get(_key)
+        if self.twophase and envelopes is not None and \
+                envelopes.rules == self._rules(name):
+            marks.append(envelopes)
+        modseq = status.get(b'HIGHESTMODSEQ', 0)
+        if modseq and any(
+                x is not None and x.modseq == modseq and
+                x.uidvalidity == status.get(b'UIDVALIDITY') for x in marks):
+            logger.info('Email(%s[%s]) NOT CHANGED SINCE MODSEQ %s', user,
+                        name, modseq)
+            return True
+        return False
+
+    def _order(self, items):
+        #semaphores wake waiters in order, the first items start first
+        if self.order == 'largest':
+            return sorted(items, key=lambda x: -x[2])
+        if self.order == 'inbox':
+            return sorted(items, key=lambda x: (x[1].upper() != 'INBOX', -x[2]))
+        return items
+
+    async def _work(self, u, p, name):
+        async with self._account_semaphore(u):
+            await self._sync_folder(u, p, name)
+
+    async def _download_folder(self, u, p, name, c):
+        #a lost session is logged in again and the folder resumed, pages
+        #already in the watermark are not fetched twice
+        _key = '{0}-{1}'.format(u, name)
+        attempt = 0
+        while True:
+            wm = self._marks(name).get(_key)
+            before = None if wm is None else wm.dump()
+            try:
+                await self._run(self._download, u, name, c)
+                return c
+            except Exception as e:
+                wm = self._marks(name).get(_key)
+                if wm is not None and wm.dump() != before:
+                    #pages were saved, only failures in a row count
+                    attempt = 0
+                attempt += 1
+                if attempt > RELOGIN or not _disconnected(e):
+                    raise
+                logger.info('Email(%s[%s]) session lost: %s, login again', u,
+                            name, e)
+                if __debug__ and logger.isEnabledFor(logging.DEBUG):
+                    c._imap.print_log()
+                await self._run(_logout, c)
+                c = await self._login(u, p)
+                if c is None:
+                    return None
+
+    async def _idle(self, u, p, name):
+        #the IDLE session only listens, fetches go through a pooled one
+        c = None
+        retry = IDLE_RETRY
+        while not self.stopped.is_set():
+            try:
+                if c is None:
+                    c = await self._login(u, p)
+                    if c is None:
+                        if u in self.denied:
+                            #a wrong password stays wrong, more logins
+                            #only risk locking the account
+                            logger.error('Email(%s[%s]) LOGIN REFUSED, STOP '
+                                         'WATCHING', u, name)
+                            return
+                        await self._idle_run(self.stopped.wait, retry)
+                        retry = min(retry * 2, IDLE_BACKOFF)
+                        continue
+                    await self._idle_run(c.select_folder, name, readonly=True)
+                changed = await self._idle_run(self._idle_wait, c)
+                retry = IDLE_RETRY
+            except Exception as e:
+                logger.info('Email(%s[%s]) IDLE failed: %s', u, name, e)
+                if c is not None:
+                    await self._idle_run(_logout, c)
+                c = None
+                await self._idle_run(self.stopped.wait, retry)
+                retry = min(retry * 2, IDLE_BACKOFF)
+                continue
+            if changed and not self.stopped.is_set():
+                await self._sync_folder(u, p, name)
+                #a daemon never reaches the final flush, fold this
+                #account's counts into its snapshot after every sync
+                keys = ['{0}/发件人'.format(u), '{0}/收件人'.format(u)]
+                await self._run(self._flush_summary, *keys)
+                await self._run(self._compact_summary, *keys)
+        if c is not None:
+            await self._idle_run(_logout, c)
+
+    async def _idle_run(self, func, *args, **kwargs):
+        return await self.loop.run_in_executor(
+            self.idlers, functools.partial(func, *args, **kwargs))
+
+    def _idle_wait(self, conn):
+        #True when the folder may have new messages, False on renew/stop
+        if not conn.has_capability('IDLE'):
+            conn.noop()
+            return not self.stopped.wait(self.idlepoll)
+        deadline = time.time() + IDLE_RENEW
+        changed = False
+        conn.idle()
         try:
-            boxes = self._list_mailbox(c)
-            for b in boxes:
-                self._download(u, b, c)
-        except Exception as e:
-            if 'Autologout' in str(e):
-                logger.info('time expire ,auto login')
-                #relogin
-                c = IMAPClient(
-                    self.host,
-                    port=self.port,
-                    ssl=self.ssl,
-                    use_uid=True,
-                    timeout=self.timeout)
-                c.login(u, self.users.get(u))
+            while not changed and not self.stopped.is_set() and \
+                    time.time() < deadline:
+                for resp in conn.idle_check(timeout=IDLE_CHECK):
+                    if len(resp) >= 2 and resp[1] in (b'EXISTS', b'RECENT'):
+                        changed = True
+        finally:
+            conn.idle_done()
+        return changed
+
+    async def _sync_folder(self, u, p, name):
+        async with self._host_semaphore(self.host):
+            c = await self._session(u, p)
+            if c is None:
                 return
-            logger.error('handle error message %s', e)
+            try:
+                c = await self._download_folder(u, p, name, c)
+            except Exception as e:
+                logger.error('handle error message %s', e)
+                await self._run(_logout, c)
+                return
+            if c is not None:
+                await self._run(self.sessions.put, self.host, u, c)
 
-    def _save(self, user, mbox, _date, uid, subject, data):
+    def _save(self, user, mbox, _date, uid, subject, data, batch=None):
         self._mkdir(self.root, mode=0o777)
+        if self.segments is not None:
+            folder = os.path.normpath('{0}/{1}'.format(
+                self._get_dir(user), mbox))
+            if batch is not None:
+                self.writer.append(batch, folder, uid, _date, data)
+                return
+            batch = self.writer.batch()
+            self.writer.append(batch, folder, uid, _date, data)
+            batch.wait()
+            return
         p = '{0}/email/{1}/{2}/{3}'.format(self.root, self._get_dir(user),
                                            mbox, _date.strftime('%Y-%m-%d'))
-        self._mkdir(p, mode=0o777)
         p = os.path.normpath(p)
+        self._mkdir(p, mode=0o777)
         eml = '{0}/{1}-{2}.eml'.format(p, uid, _fix_name(subject))
         eml = os.path.normpath(eml)
-        try:
-            with open(eml, 'wb') as f:
-                f.write(data)
-                f.flush()
-        except IOError as e:
-            #full path
-            logger.error('write file failed ,path is %s,id is %s ,error:%s', p,
-                         uid, e)
-            #save again
-            self._save(user, mbox, _date, uid, 'InvalidFile', data)
+        fallback = os.path.normpath('{0}/{1}-InvalidFile.eml'.format(p, uid))
+        if batch is not None:
+            self.writer.submit(batch, eml, data, fallback)
+            return
+        #no page to wait on, write and wait here
+        batch = self.writer.batch()
+        self.writer.submit(batch, eml, data, fallback)
+        batch.wait()
 
     def _save_login_failed(self, user, password):
         _pp = '{0}/summary/登陆失败'.format(self.root)
         self._mkdir(_pp)
+        _name = 'content' if self.shard is None else 'content-{0}'.format(
+            self.shard)
         try:
-            _list = set()
-            if os.path.exists('{0}/content.txt'.format(_pp)):
-                with open('{0}/content.txt'.format(_pp), 'r+') as f:
-                    for line in f.readlines():
-                        _list.add(line)
-            if _list.__contains__('{0}:{1}'.format(user, password)):
-                return
-            _list.add('{0}:{1}'.format(user, password))
-            with open('{0}/content.txt'.format(_pp), 'w+') as f:
-                f.write('\n'.join(_list))
-                f.flush()
+            #logins run concurrently, file is rewritten as a whole
+            with self.failed_lock:
+                _list = set()
+                if os.path.exists('{0}/{1}.txt'.format(_pp, _name)):
+                    with open('{0}/{1}.txt'.format(_pp, _name), 'r+') as f:
+                        for line in f.readlines():
+                            _list.add(line)
+                if _list.__contains__('{0}:{1}'.format(user, password)):
+                    return
+                _list.add('{0}:{1}'.format(user, password))
+                with open('{0}/{1}.txt'.format(_pp, _name), 'w+') as f:
+                    f.write('\n'.join(_list))
+                    f.flush()
         except Exception as e:
             logger.error('save file error %s', e)
 
-    def _load_meta(self):
+    def _own_meta(self, key):
+        #only keys of our users, a shard must not rewrite another's files
+        return any(key.startswith(u + '-') for u in self.users)
+
+    def _load_marks(self, ext):
         mp = '{0}/.meta'.format(self.root)
         self._mkdir(mp, mode=0o777)
-        cache = {}
+        marks = {}
         for f in os.listdir(mp):
+            if not f.endswith(ext):
+                continue
+            _key = f[:-len(ext)].replace('--', '/')
+            if not self._own_meta(_key):
+                continue
+            wm = Watermark()
             with open(mp + '/' + f, 'r') as ff:
-                cache[f.replace('.meta', '').replace('--', '/')] = set([
-                    int(x) if x != '' else -10000
-                    for x in str(ff.read()).split(',')
-                ])
+                for line in ff:
+                    wm.replay(line)
+                    wm.lines += 1
+            wm.journal = []
+            marks[_key] = wm
+        return marks
+
+    def _load_meta(self):
+        mp = '{0}/.meta'.format(self.root)
+        cache = self._load_marks('.uids')
+        for f in os.listdir(mp):
+            if not f.endswith('.meta'):
+                continue
+            _key = f.replace('.meta', '').replace('--', '/')
+            if not self._own_meta(_key):
+                continue
+            if _key not in cache:
+                #one shot migration of the old comma separated uid list
+                with open(mp + '/' + f, 'r') as ff:
+                    wm = Watermark()
+                    wm.update([
+                        int(x) for x in str(ff.read()).split(',')
+                        if x != '' and int(x) > 0
+                    ])
+                cache[_key] = wm
+                self._write_meta(_key, wm)
+                logger.info('migrate meta file %s', f)
+            os.remove(mp + '/' + f)
         logger.info('load meta file ok')
         return cache
 
@@ -283,48 +1864,129 @@ class Mailer():
             if not os.path.exists(up):
                 continue
             for f in os.listdir(up):
-                self.summary[f] = self._read_summary(
-                    os.path.join(up, f, '汇总文件.txt'))
+                self._recover_summary(os.path.join(up, f))
+                #snapshot first, then replay deltas of an unfinished run
+                _s = {}
+                self._read_summary(os.path.join(up, f, '汇总文件.txt'), _s)
+                log = os.path.join(up, f, '汇总文件.log')
+                self._read_summary(log, _s)
+                self.summary['{0}/{1}'.format(u, f)] = _s
+                if os.path.exists(log):
+                    #fold it in now, a torn tail would glue onto the
+                    #next append
+                    self._compact_summary('{0}/{1}'.format(u, f))
         logger.info('load summary file ok')
 
-    def _read_summary(self, path):
-        _s = {}
+    def _recover_summary(self, path):
+        #finish or undo a compaction cut short, see _compact_summary
+        txt = os.path.join(path, '汇总文件.txt')
+        old = os.path.join(path, '汇总文件.log.old')
+        if os.path.exists(old):
+            if os.path.exists(txt + '.tmp'):
+                #the new snapshot holds the old log, it only missed the rename
+                os.replace(txt + '.tmp', txt)
+            os.remove(old)
+        elif os.path.exists(txt + '.tmp'):
+            #the log was never moved, snapshot plus log are still whole
+            os.remove(txt + '.tmp')
+
+    def _read_summary(self, path, _s=None):
+        if _s is None:
+            _s = {}
+        if not os.path.exists(path):
+            return _s
         with open(path, 'r') as f:
             for line in f.readlines():
-                arr = line.split(':')
+                arr = line.strip().rsplit(':', 1)
                 if len(arr) < 2:
                     continue
-                _s[arr[0]] = arr[1]
+                try:
+                    _s[arr[0]] = _s.get(arr[0], 0) + int(arr[1])
+                except ValueError:
+                    #a crash mid append leaves a torn last line
+                    continue
         return _s
 
     def _flush_meta(self, key=None):
         mp = '{0}/.meta'.format(self.root)
         self._mkdir(mp)
         self._hidden(mp)
-        if key is not None:
-            value = self.cache.get(key, None)
-            if value is None:
-                return
-            with open(mp + '/' + key.replace('/', '--') + '.meta', 'w+') as f:
-                f.write(','.join(str(x) for x in value))
+        for marks, ext in ((self.cache, '.uids'), (self.envelopes, '.envs')):
+            if key is None:
+                #flush all, compact every log to its ranges
+                for k, v in list(marks.items()):
+                    self._write_meta(k, v, ext)
+                continue
+            value = marks.get(key, None)
+            if value is None or not value.journal:
+                continue
+            #append only the new ranges, a torn line is skipped on load
+            with open(mp + '/' + key.replace('/', '--') + ext, 'a') as f:
+                f.write(''.join(line + '\n' for line in value.journal))
                 f.flush()
-        else:
-            #flush all
-            for k, v in list(self.cache.items()):
-                with open(mp + '/' + k.replace('/', '--') + '.meta',
-                          'w+') as f:
-                    f.write(','.join(str(x) for x in v))
-                    f.flush()
+                os.fsync(f.fileno())
+            value.lines += len(value.journal)
+            value.journal = []
+            if value.lines > 0x400 and value.lines > 4 * len(value.los):
+                self._write_meta(key, value, ext)
+
+    def _write_meta(self, key, value, ext='.uids'):
+        mp = '{0}/.meta'.format(self.root)
+        path = mp + '/' + key.replace('/', '--') + ext
+        lines = value.dump()
+        with open(path + '.tmp', 'w') as f:
+            f.write(''.join(line + '\n' for line in lines))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        value.lines = len(lines)
+        value.journal = []
+
+    def _mark_summary(self, *args):
+        #one message handled, flush when the batch is full or too old
+        now = time.time()
+        with self.summary_lock:
+            for _key in args:
+                pending = self.summary_pending.get(_key, 0) + 1
+                self.summary_pending[_key] = pending
+                stamp = self.summary_stamp.setdefault(_key, now)
+                if pending >= self.summarybatch or \
+                        now - stamp >= self.summaryinterval:
+                    self._flush_summary(_key)
 
     def _flush_summary(self, *args):
-        for _key in args:
-            #parser key
-            record = self.summary.get(_key)
-            if record is None:
-                continue
-            #clean code, value is map
-            self._save_summary(_key, '\n'.join(
-                ['{0}:{1}'.format(k, v) for k, v in list(record.items())]))
+        with self.summary_lock:
+            for _key in args:
+                self.summary_pending[_key] = 0
+                self.summary_stamp[_key] = time.time()
+                #parser key
+                delta = self.deltas.pop(_key, None)
+                if not delta:
+                    continue
+                #only the changed counters are appended
+                self._append_summary(_key, ''.join([
+                    '{0}:{1}\n'.format(k, v) for k, v in list(delta.items())
+                ]))
+
+    def _compact_summary(self, *args):
+        #rewrite the snapshots of args (default all) and drop their logs
+        with self.summary_lock:
+            for _key, record in list(self.summary.items()):
+                if args and _key not in args:
+                    continue
+                #clean code, value is map
+                content = '\n'.join(
+                    ['{0}:{1}'.format(k, v) for k, v in list(record.items())])
+                tmp = self._save_summary(_key, content)
+                #new snapshot aside, then the log aside: a crash at any
+                #point leaves files _recover_summary tells apart, so the
+                #log is never lost and never counted twice
+                log = '{0}/summary/{1}/汇总文件.log'.format(self.root, _key)
+                if os.path.exists(log):
+                    os.replace(log, log + '.old')
+                os.replace(tmp, tmp[:-len('.tmp')])
+                if os.path.exists(log + '.old'):
+                    os.remove(log + '.old')
 
     def _parser_mail(self, mail):
         #fuck email address
@@ -335,30 +1997,51 @@ class Mailer():
 
     #save summary
     def _save_summary(self, path_suffix, content):
+        #next to the snapshot, the caller renames it over
+        path = '{0}/summary/{1}'.format(self.root, path_suffix)
+        self._mkdir(path)
+        self._hidden(path)
+        tmp = '{0}/汇总文件.txt.tmp'.format(path)
+        with open(tmp, 'w+') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        return tmp
+
+    def _append_summary(self, path_suffix, content):
         path = '{0}/summary/{1}'.format(self.root, path_suffix)
         self._mkdir(path)
         self._hidden(path)
-        with open('{0}/汇总文件.txt'.format(path), 'w+') as f:
+        with open('{0}/汇总文件.log'.format(path), 'a') as f:
             f.write(content)
             f.flush()
 
     def _update_record(self, _key, *args):
-        record = self.summary.get(_key)
-        if record is None:
-            self.summary[_key] = {}
-            record = self.summary[_key]
+        names = []
         for u in args:
             if u is None or u.strip() == '':
                 continue
             uu = self._parser_mail(u)
             if uu is None or uu.strip() == '':
                 continue
-            value = record.get(uu, None)
-            if value is None:
-                record[uu] = 0
-            record[uu] += 1
+            names.append(uu)
+        with self.summary_lock:
+            record = self.summary.get(_key)
+            if record is None:
+                self.summary[_key] = {}
+                record = self.summary[_key]
+            delta = self.deltas.setdefault(_key, {})
+            for uu in names:
+                value = record.get(uu, None)
+                if value is None:
+                    record[uu] = 0
+                record[uu] += 1
+                delta[uu] = delta.get(uu, 0) + 1
 
     def _hidden(self, path):
+        if path in _HIDDEN:
+            return
+        _HIDDEN.add(path)
         if os.name == 'nt':
             import ctypes
             ret = ctypes.windll.kernel32.SetFileAttributesW(
@@ -370,9 +2053,17 @@ class Mailer():
             logger.debug('os is unix like system, do nothing')
 
     def _mkdir(self, path, mode=0o777):
-        if os.path.exists(path):
+        if path in _DIRS:
             return
-        os.makedirs(path, mode)
+        #one mkdir when the parent exists, makedirs only for new trees
+        try:
+            os.mkdir(path, mode)
+        except FileExistsError:
+            pass
+        except FileNotFoundError:
+            #other sessions may create the same parent at the same time
+            os.makedirs(path, mode, exist_ok=True)
+        _DIRS.add(path)
 
     def _get_dir(self, user):
         if self.groups is None:
@@ -384,6 +2075,87 @@ class Mailer():
         return user
 
 
+def _run_shard(shard, kwargs, users, daemon=False):
+    #worker process entry, module level so spawn can pickle it
+    #a forked child must not reuse the loop of its parent
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    m = Mailer(shard=shard, **kwargs, **users)
+    if daemon:
+        m.watch()
+    else:
+        m.download()
+
+
+def _merge_login_failed(root):
+    _pp = '{0}/summary/登陆失败'.format(root)
+    if not os.path.exists(_pp):
+        return
+    _list = set()
+    shards = [
+        f for f in os.listdir(_pp)
+        if f.startswith('content-') and f.endswith('.txt')
+    ]
+    for f in ['content.txt'] + shards:
+        if not os.path.exists(os.path.join(_pp, f)):
+            continue
+        with open(os.path.join(_pp, f), 'r') as ff:
+            _list.update(line.strip() for line in ff if line.strip() != '')
+    if not shards:
+        return
+    with open(os.path.join(_pp, 'content.txt'), 'w+') as f:
+        f.write('\n'.join(sorted(_list)))
+        f.flush()
+    for f in shards:
+        os.remove(os.path.join(_pp, f))
+
+
+def supervise(processes, users, daemon=False, **kwargs):
+    #shard users over worker processes, each with its own Mailer and pool
+    #summary and meta files are per user so shards never share one
+    shards = [{} for _ in range(processes)]
+    for i, u in enumerate(sorted(users)):
+        shards[i % processes][u] = users[u]
+    #host limits are for the whole run, every shard gets its part, a
+    #hostlimit of 0 means poolsize and is split the same way
+    hostlimit = kwargs.get('hostlimit', 0)
+    if hostlimit <= 0:
+        hostlimit = kwargs.get('poolsize', 0x0a)
+    kwargs['hostlimit'] = max(1, hostlimit // processes)
+    for key in ('loginrate', 'maxrate'):
+        if kwargs.get(key, 0) > 0:
+            kwargs[key] = float(kwargs[key]) / processes
+    if kwargs.get('hostrates'):
+        kwargs['hostrates'] = dict(
+            (k, float(v) / processes) for k, v in kwargs['hostrates'].items())
+    workers = []
+    for i, shard in enumerate(shards):
+        if not shard:
+            continue
+        w = multiprocessing.Process(target=_run_shard,
+                                    args=(i, kwargs, shard, daemon))
+        w.start()
+        workers.append(w)
+    failed = 0
+    for w in workers:
+        try:
+            w.join()
+        except KeyboardInterrupt:
+            #children got the same ctrl-c, let them finish
+            w.join()
+        except SystemExit:
+            #a SIGTERM only reaches the supervisor, pass it on
+            for x in workers:
+                if x.is_alive():
+                    x.terminate()
+            w.join()
+        if w.exitcode != 0:
+            logger.error('shard %s exit with %s', w.name, w.exitcode)
+            failed += 1
+    _merge_login_failed(kwargs['root'])
+    logger.info('%d shards done, %d failed', len(workers), failed)
+    return failed
+
+
 def parser(*args):
     p = argparse.ArgumentParser(description='simple command line parser')
     #two args
@@ -392,6 +2164,9 @@ def parser(*args):
     p.add_argument('--debug', help='set log level to debug')
     p.add_argument('--info', help='set log level to info')
     p.add_argument('--warn', help='set log level to warn')
+    p.add_argument('--convert',
+                   action='store_true',
+                   help='pack the email tree under data path into segments')
     return p.parse_args(args)
 
 
@@ -421,6 +2196,9 @@ if __name__ == '__main__':
     if not os.path.exists(cp) or not os.path.exists(dp):
         logger.error('config file or data path is not exist')
         os._exit(1)
+    if p.convert:
+        convert(dp)
+        sys.exit(0)
     ini = parser_ini(cp)
     users = dict()
     for item in ini.get('mailer', 'users').split(','):
@@ -446,13 +2224,64 @@ if __name__ == '__main__':
         'mailer', 'pagesize')
     poolsize = 0x0a if ini.getint('mailer', 'poolsize') == 0 else ini.getint(
         'mailer', 'poolsize')
-    m = Mailer(
+    kwargs = dict(
         root=dp,
         imap=imap,
         ssl=ssl,
         groups=mapping,
         pagesize=pagesize,
+        poolsize=poolsize,
+        hostlimit=ini.getint('mailer', 'hostlimit', fallback=0),
+        loginrate=ini.getfloat('mailer', 'loginrate', fallback=0),
+        spoolsize=ini.getint('mailer', 'spoolsize', fallback=0),
+        incremental=ini.getboolean('mailer', 'incremental', fallback=True),
+        maxrate=ini.getfloat('mailer', 'maxrate', fallback=0),
+        prefetch=ini.getint('mailer', 'prefetch', fallback=1),
+        twophase=ini.getboolean('mailer', 'twophase', fallback=False),
+        summaryonly=ini.getboolean('mailer', 'summaryonly', fallback=False),
+        maxbody=ini.getint('mailer', 'maxbody', fallback=0),
+        bodyfolders=[
+            f for f in ini.get('mailer', 'bodyfolders', fallback='').split(',')
+            if f != ''
+        ],
+        writers=ini.getint('mailer', 'writers', fallback=2),
+        fsync=ini.get('mailer', 'fsync', fallback='none'),
+        dedup=ini.getboolean('mailer', 'dedup', fallback=False),
+        output=ini.get('mailer', 'output', fallback='files'),
+        segmentsize=ini.getint('mailer', 'segmentsize',
+                               fallback=SEGMENT_SIZE),
+        codec=ini.get('mailer', 'codec', fallback='none'),
+        codeclevel=ini.getint('mailer', 'codeclevel', fallback=-1),
+        bodysince=datetime.datetime.strptime(
+            ini.get('mailer', 'bodysince'), '%Y-%m-%d').date()
+        if ini.has_option('mailer', 'bodysince') else None,
+        hostrates=dict((k[len('maxrate.'):], float(v))
+                       for k, v in ini.items('mailer')
+                       if k.startswith('maxrate.')),
+        summarybatch=ini.getint('mailer', 'summarybatch', fallback=0x64),
+        summaryinterval=ini.getint('mailer', 'summaryinterval', fallback=60),
+        keepalive=ini.getint('mailer', 'keepalive', fallback=300),
+        idlefolders=[
+            f for f in ini.get('mailer', 'idlefolders', fallback='').split(',')
+            if f != ''
+        ],
+        idlepoll=ini.getint('mailer', 'idlepoll', fallback=60),
+        order=ini.get('mailer', 'order', fallback='largest'),
+        usersessions=ini.getint('mailer', 'usersessions', fallback=1),
+        trace=ini.get('mailer', 'trace', fallback='ring'),
+        tracefile=ini.get('mailer', 'tracefile', fallback=None),
         timeout=3000 if ini.getint('mailer', 'timeout') == 0 else ini.getint(
-            'mailer', 'timeout'),
-        **users)
-    m.download()
\ No newline at end of file
+            'mailer', 'timeout'))
+    processes = ini.getint('mailer', 'processes', fallback=1)
+    daemon = ini.getboolean('mailer', 'daemon', fallback=False)
+    if daemon:
+        #stop like ctrl-c, sessions leave IDLE and the meta is flushed
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    if processes > 1:
+        supervise(processes, users, daemon, **kwargs)
+    else:
+        m = Mailer(**kwargs, **users)
+        if daemon:
+            m.watch()
+        else:
+            m.download()
\ No newline at end of file